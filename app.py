@@ -3,11 +3,20 @@ import dash_bootstrap_components as dbc
 from dash_bootstrap_components._components.Label import Label
 import dash_core_components as dcc
 import dash_html_components as html
-from dash.dependencies import Input, Output, State
+from dash.dependencies import ClientsideFunction, Input, Output, State, MATCH
 from dash_html_components.Div import Div
 from data import *
 from plots import *
 from flask_caching import Cache
+from functools import partial, wraps
+import hashlib
+import inspect
+from registry import DatasetRegistry
+from coalesce import coalesced, leased
+from render import FigureStore, getRenderedSchools, summarize
+import compression
+import metrics
+import os
 import sys
 
 app = dash.Dash(external_stylesheets=[dbc.themes.BOOTSTRAP],
@@ -17,20 +26,104 @@ app = dash.Dash(external_stylesheets=[dbc.themes.BOOTSTRAP],
 ], suppress_callback_exceptions=True
 )
 
+# Every worker keeps the last OCPS_CACHE_MEMORY_SIZE results it served in
+# memory, in front of the cache they share: _cache/ or, with
+# OCPS_CACHE_REDIS_URL set, redis. OCPS_CACHE_MEMORY_SIZE=0 goes straight to
+# the shared cache.
+cache_memory_size = int(os.environ.get('OCPS_CACHE_MEMORY_SIZE', 200))
+cache_redis_url = os.environ.get('OCPS_CACHE_REDIS_URL', '')
+shared_cache_type = 'RedisCache' if cache_redis_url else 'cache_backends.lruFilesystem'
+
 cache = Cache(app.server, config={
-    # try 'filesystem' if you don't want to setup redis
-    'CACHE_TYPE': 'filesystem',
+    'CACHE_TYPE': 'cache_backends.twoTier' if cache_memory_size else shared_cache_type,
+    'CACHE_SHARED_TYPE': shared_cache_type,
+    'CACHE_MEMORY_THRESHOLD': cache_memory_size,
     'CACHE_DIR': '_cache',
-    # Cache is valid for a day. (Cache is cleared when we get new data in the nightly scripts)
-    'CACHE_DEFAULT_TIMEOUT': 60*60*24
+    'CACHE_REDIS_URL': cache_redis_url,
+    'CACHE_KEY_PREFIX': 'ocps_',
+    # Entries never expire, they are keyed on the data, code and settings
+    # they were built from (see memoize) and the least recently used go once there are
+    # more than OCPS_CACHE_SIZE of them. Redis evicts by its own maxmemory
+    # policy instead.
+    'CACHE_DEFAULT_TIMEOUT': 0,
+    'CACHE_THRESHOLD': int(os.environ.get('OCPS_CACHE_SIZE', 2000)),
 })
 
+# Set OCPS_CACHE_CONTENT_HASH=1 to key the cache on the contents of the
+# source files rather than their size and mtime, so that files rewritten
+# with the same data don't invalidate it
+cache_content_hash = os.environ.get(
+    'OCPS_CACHE_CONTENT_HASH', '') not in ('', '0')
+
+
+def getDatasetVersion(dataset, *args):
+    return getFingerprint(dataset, cache_content_hash)
+
+
+def getDatasetIdVersion(dataset_id, *args):
+    return getDatasetVersion(datasets[dataset_id])
+
+
+def getDataFingerprint():
+    fingerprints = [getDatasetVersion(dataset) for dataset in datasets.values()]
+    return hashlib.sha1(repr(fingerprints).encode()).hexdigest()
+
+
+# The code and the settings that change what's built, the cache is kept
+# across restarts
+deploy_version = compression.getDeployVersion()
+
+
+def memoize(version):
+    """cache.memoize, keyed on version(*args), the data the call is built
+    from, and on deploy_version as well as on the arguments. Calls that leave
+    out arguments with defaults share their entries with those that don't.
+
+    Misses are built under a lease in the cache, so that only one of the
+    workers sharing it builds a given entry, see leased.
+    """
+    def decorator(fn):
+        signature = inspect.signature(fn)
+
+        @cache.memoize(make_name=lambda fname: fn.__name__ + '@' + deploy_version)
+        def cached(data_version, *args):
+            return fn(*args)
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            args = (version(*bound.args),) + bound.args
+            key = cached.make_cache_key(cached.uncached, *args)
+            return leased(cache, key, lambda: cached(*args), fn.__name__)
+        return wrapper
+    return decorator
+
+
+# Data and Plots objects are kept in memory rather than in the cache above,
+# pickling whole DataFrames to disk is slower than just holding onto them.
+registry = DatasetRegistry()
+
+# Figures pre-rendered by render.py, used while they match the data on disk
+store = FigureStore()
+
+# /metrics, only when OCPS_METRICS is set
+metrics.register(app.server)
+
+
+def getPagesVersion():
+    # ABOUT.md is read on every visit to /about
+    about = os.stat("ABOUT.md")
+    return getDataFingerprint() + '-%d-%d' % (about.st_size, about.st_mtime_ns)
+
+
+# Compressed and cached callback responses, when OCPS_COMPRESS is set
+compression.register(app.server, getPagesVersion)
+
 if len(sys.argv) > 1 and sys.argv[1] == 'debug':
     print("clearing cache")
     cache.clear()
 
-config = {'modeBarButtonsToRemove': ["autoScale2d", "autoscale", "editInChartStudio", "editinchartstudio", "hoverCompareCartesian", "hovercompare", "lasso", "lasso2d", "orbitRotation", "orbitrotation", "pan", "pan2d", "pan3d", "reset", "resetCameraDefault3d", "resetCameraLastSave3d", "resetGeo", "resetSankeyGroup", "resetScale2d", "resetViewMapbox", "resetViews", "resetcameradefault",
-                                     "resetcameralastsave", "resetsankeygroup", "resetscale", "resetview", "resetviews", "select", "select2d", "sendDataToCloud", "senddatatocloud", "tableRotation", "tablerotation", "toImage", "toggleHover", "toggleSpikelines", "togglehover", "togglespikelines", "toimage", "zoom", "zoom2d", "zoom3d", "zoomIn2d", "zoomInGeo", "zoomInMapbox", "zoomOut2d", "zoomOutGeo", "zoomOutMapbox", "zoomin", "zoomout"]}
 
 navbar = dbc.NavbarSimple(
     brand="(Unofficial) OCPS Covid Dashboard",
@@ -51,6 +144,8 @@ app.layout = html.Div(
             dbc.NavItem(dbc.NavLink(
                 "By School", href="/school", active='exact')),
             dbc.NavItem(dbc.NavLink("Map", href="/map", active='exact')),
+            dbc.NavItem(dbc.NavLink(
+                "Compare years", href="/compare", active='exact')),
             dbc.DropdownMenu(
                 label="2021-2022",
                 children=[
@@ -58,7 +153,11 @@ app.layout = html.Div(
                     dbc.DropdownMenuItem("2020-2021", id="y2020"),
                 ],
                 id='year_dd'
-            )
+            ),
+            # Restricts every page to the cases between the dates
+            dbc.NavItem(dcc.DatePickerRange(
+                id='date_range', clearable=True, start_date_placeholder_text="From",
+                end_date_placeholder_text="To")),
         ], pills=True, fill=True),
         html.Hr(),
         html.Div(id="main_content", children=[])
@@ -66,46 +165,87 @@ app.layout = html.Div(
 )
 
 
-@cache.memoize()
-def getDataPlots(dataset):
-    data = Data(dataset)
-    plots = Plots(data)
-    return data, plots
+@metrics.timed('getDataPlots')
+def getDataPlots(dataset, start=None, end=None):
+    return registry.getWindow(dataset, start, end)
 
 
-@cache.memoize()
-def showGraphs(dataset):
-    data, plots = getDataPlots(dataset)
+def isWholeYear(start, end):
+    # Only the whole year's figures are pre-rendered
+    return start is None and end is None
 
-    children = [
-        getTotals(data.getTotalConfirmedCases(), data.getTotalEmployeeCases(
-        ), data.getTotalStudentCases(), data.getTotalVendorVisitorCases(), data.getTotalStudentCount()),
-        dbc.Row([dbc.Col(dbc.Card(
-            [dbc.CardHeader(html.B("Confirmed cases by Type")), ]), align='center')]),
-        dcc.Graph(id="type_count", figure=plots.plotByType(), config=config),
-        dbc.Row([dbc.Col(dbc.Card(
-            [dbc.CardHeader(html.B("Confirmed cases by Level")), ]), align='center')]),
-        dcc.Graph(id="level_count", figure=plots.plotByLevel(), config=config),
 
-        dbc.Row([dbc.Col(dbc.Card(
-            [dbc.CardHeader(html.B("Distribution of cases by Level")), ]), align='center')]),
-        dcc.Graph(id="box_plot", figure=plots.plotDistribution(), config=config),
-        dbc.Row([dbc.Col(dbc.Card([dbc.CardHeader(html.B(
-            "Distribution of confirmed cases in Elementary schools")), ]), align='center')]),
-        dcc.Graph(
-            figure=plots.plotDistributionByLevel('Elementary'), config=config),
-        dbc.Row([dbc.Col(dbc.Card([dbc.CardHeader(html.B(
-            "Distribution of confirmed cases in Middle schools")), ]), align='center')]),
-        dcc.Graph(
-            figure=plots.plotDistributionByLevel('Middle'), config=config),
-        dbc.Row([dbc.Col(dbc.Card([dbc.CardHeader(html.B(
-            "Distribution of confirmed cases in High schools")), ]), align='center')]),
-        dcc.Graph(
-            figure=plots.plotDistributionByLevel('High'), config=config),
+@metrics.timed('getSummary')
+@coalesced
+@memoize(getDatasetVersion)
+@metrics.counted('getSummary')
+def getSummary(dataset, start=None, end=None):
+    # Walks every school, and the schools page and its filter need it on
+    # every change
+    summary = None
+    if isWholeYear(start, end):
+        summary = store.load(dataset, 'summary')
+    if summary is None:
+        data, _ = getDataPlots(dataset, start, end)
+        summary = summarize(data)
+    return summary
+
+
+@metrics.timed('getDatasetFigure')
+@coalesced
+@memoize(getDatasetIdVersion)
+@metrics.counted('getDatasetFigure')
+def getDatasetFigure(dataset_id, kind, start=None, end=None):
+    dataset = datasets[dataset_id]
+    figure = None
+    if isWholeYear(start, end):
+        figure = store.load(dataset, kind)
+    if figure is None:
+        _, plots = getDataPlots(dataset, start, end)
+        figure = serveFigure(dataset_figures[kind](plots))
+    return figure
+
+
+def getModeGraph(graph_id, base=None, **kwargs):
+    """A graph of a client_modes figure along with a dropdown of its modes.
+
+    The figure as built goes in a store next to the graph, and the
+    clientside applyMode callback fills the graph from it for the selected
+    mode, so switching modes doesn't go back to the server.
+    """
+    modes = figure_modes[graph_id['kind']]
 
+    def getId(part):
+        return dict(graph_id, type=graph_id['type']+'_'+part)
 
+    return [
+        dcc.Dropdown(id=getId('mode'), options=[{'label': label, 'value': transform} for label, transform, _ in modes],
+                     value=modes[0][1], clearable=False, searchable=False),
+        dcc.Loading([dcc.Store(id=getId('base'), data=base),
+                     dcc.Graph(id=graph_id, config=config, **kwargs)]),
     ]
 
+
+@metrics.timed('showGraphs')
+@coalesced
+@memoize(getDatasetVersion)
+@metrics.counted('showGraphs')
+def showGraphs(dataset, start=None, end=None):
+    summary = getSummary(dataset, start, end)
+
+    # The graphs start out empty and are filled in by updateTotalsGraph, one
+    # request each, so the totals show up without waiting on every figure.
+    children = [getTotals(*summary['totals'])]
+    for header, kind in totals_graphs:
+        children.append(dbc.Row([dbc.Col(dbc.Card(
+            [dbc.CardHeader(html.B(header)), ]), align='center')]))
+        if client_modes and kind in figure_modes:
+            children.extend(getModeGraph(
+                {'type': 'totals_mode_graph', 'kind': kind}))
+        else:
+            children.append(dcc.Loading(dcc.Graph(
+                id={'type': 'totals_graph', 'kind': kind}, config=config)))
+
     return children
 
 
@@ -136,12 +276,35 @@ def getTotals(total, employee, student, vendor, per_capita, margin="5px"):
         ])], style={'margin': margin})
 
 
-@cache.memoize()  # in seconds
-def showMap(dataset):
-    _, plots = getDataPlots(dataset)
+@metrics.timed('showMap')
+@coalesced
+@memoize(getDatasetVersion)
+@metrics.counted('showMap')
+def showMap(dataset, start=None, end=None):
+    figure = getDatasetFigure(dataset['id'], 'map', start, end)
+    dates = figure['layout']['meta']['dates']
+    # The graph is filled in by the clientside applyRange callback, which
+    # sizes the schools by the cases within the slider's range of dates
+    marks = {i: date[:7] for i, date in enumerate(dates) if date.endswith('-01')}
+    return [
+        dcc.RangeSlider(id='map_range', min=0, max=len(dates)-1, step=1,
+                        value=[0, len(dates)-1], marks=marks, allowCross=False),
+        dcc.Store(id='map_base', data=figure),
+        dcc.Graph(id="map", style={'height': '100vh'}, config=config)
+    ]
+
+
+@metrics.timed('showCompare')
+@coalesced
+@memoize(getDataFingerprint)
+@metrics.counted('showCompare')
+def showCompare():
+    # Every year side by side, the year picked and the dates don't apply
+    years = registry.getYears(list(datasets.values())[::-1])
     return [
-        dcc.Graph(id="map", figure=plots.plotMap(), style={
-                  'height': '100vh'}, config=config)
+        dbc.Row([dbc.Col(dbc.Card(
+            [dbc.CardHeader(html.B("Cumulative cases by day of the school year")), ]), align='center')]),
+        dcc.Graph(figure=serveFigure(plotYearOverYear(years)), config=config),
     ]
 
 
@@ -156,11 +319,9 @@ def showAbout():
     ]
 
 
-def showSchools(dataset):
-    data = Data(dataset)
-
+def showSchools(dataset, start=None, end=None):
     all_schools = []
-    for loc in data.getLocationsList():
+    for loc in getSummary(dataset, start, end)['locations']:
         all_schools.append({'label': loc, 'value': loc})
 
     schools_dd = dcc.Dropdown(
@@ -173,33 +334,61 @@ def showSchools(dataset):
     return html.Div([
         schools_dd,
         html.Div(
-            children=updateSchools(dataset),
+            children=updateSchools(dataset, [], start, end),
             id="schools_div"
         )
     ])
 
 
-@cache.memoize()  # in seconds
-def updateSchools(dataset, schools=[]):
+@metrics.timed('getSchoolFigure')
+@coalesced
+@memoize(getDatasetIdVersion)
+@metrics.counted('getSchoolFigure')
+def getSchoolFigure(dataset_id, school, kind, start=None, end=None):
+    # Cached per school rather than per selection, so adding a school to the
+    # filter only builds the figures for that school.
+    dataset = datasets[dataset_id]
+    figure = None
+    if isWholeYear(start, end):
+        figure = store.load(dataset, kind, school)
+    if figure is None:
+        _, plots = getDataPlots(dataset, start, end)
+        figure = serveFigure(school_figures[kind](plots, school))
+    return figure
+
+
+@metrics.timed('updateSchools')
+def updateSchools(dataset, schools=[], start=None, end=None):
+    if len(schools) > 0:
+        summary = getSummary(dataset, start, end)
+        # Schools picked before the dates changed may have no cases left
+        schools = [school for school in schools if school in summary['schools']]
     if len(schools) > 0:
-        data, plots = getDataPlots(dataset)
+        # Figures that aren't cached yet get built side by side
+        keys = [(school, kind) for school in schools for kind in school_figures]
+        figures = dict(zip(keys, buildFigures(
+            [partial(getSchoolFigure, dataset['id'], school, kind, start, end) for school, kind in keys])))
+
+        def getGraph(school, kind, **kwargs):
+            if client_modes:
+                return html.Div(getModeGraph({'type': 'school_mode_graph', 'kind': kind, 'school': school},
+                                             base=figures[(school, kind)]))
+            return dcc.Graph(figure=figures[(school, kind)], config=config, **kwargs)
 
         ret = []
         for school in schools:
-            level = data.getLevelForSchool(school)
+            level = summary['schools'][school]['level']
             ret.extend([
                 dbc.Row([dbc.Col(dbc.Card([dbc.CardHeader(html.B(school))]))]),
                 getTotals(
-                    *data.getTotalsForSchool(school), "5px 50px 5px"),
+                    *summary['schools'][school]['totals'], "5px 50px 5px"),
                 html.Br(),
                 html.P("Confirmed cases by type", style={'margin': '5px'}),
-                dcc.Graph(
-                    id="type_count", figure=plots.plotBySchool(school), config=config),
+                getGraph(school, 'by_type', id="type_count"),
                 html.Br(),
                 html.P(
                     "Distribution vs %s and all schools" % (level), style={'margin': '5px'}),
-                dcc.Graph(
-                    figure=plots.plotDistributionsForSchool(school), config=config)
+                getGraph(school, 'distribution')
             ])
 
         return ret
@@ -216,6 +405,12 @@ def updateSchools(dataset, schools=[]):
 
 @app.callback(
     Output("year_store", "data"),
+    # The dates picked for one year don't mean anything for the other. They
+    # are cleared here rather than in a callback of their own on year_store,
+    # so that display_router runs once, with the new year and no dates,
+    # instead of once with the old dates and again after they're cleared
+    Output('date_range', 'start_date'),
+    Output('date_range', 'end_date'),
     [
         Input("y2021", "n_clicks_timestamp"),
         Input("y2020", "n_clicks_timestamp"),
@@ -223,11 +418,11 @@ def updateSchools(dataset, schools=[]):
 )
 def changeYear(y2021, y2020):
     if y2020 is not None and y2021 is None:
-        return{'year': '2020'}  # Must have clicked 2020
+        return {'year': '2020'}, None, None  # Must have clicked 2020
     elif y2020 is not None and y2021 is not None and y2020 > y2021:
-        return{'year': '2020'}  # Must have clicked 2020
+        return {'year': '2020'}, None, None  # Must have clicked 2020
     else:
-        return {'year': '2021'}  # default
+        return {'year': '2021'}, None, None  # default
 
 
 @app.callback(
@@ -235,22 +430,32 @@ def changeYear(y2021, y2020):
     Output("main_content", "children"),
     [Input('year_store', 'data'),
      Input('url', 'pathname'),
+     Input('date_range', 'start_date'),
+     Input('date_range', 'end_date'),
      ]
 )
-def display_router(data, url):
+def display_router(data, url, start=None, end=None):
     dataset = getDataset(data)
     year = '2021-2022'
     if data is not None and data['year'] == '2020':
         year = '2020-2021'
 
+    if not isWholeYear(start, end) and url not in ["/about", "/compare"]:
+        try:
+            getDataPlots(dataset, start, end)
+        except ValueError:
+            return year, [dbc.Alert("No cases in %s between the dates picked" % year, color='warning')]
+
     if url is not None and url == "/map":
-        return year, showMap(dataset)
+        return year, showMap(dataset, start, end)
     if url is not None and url == "/school":
-        return year, showSchools(dataset)
+        return year, showSchools(dataset, start, end)
     if url is not None and url == "/about":
         return year, showAbout()
+    if url is not None and url == "/compare":
+        return year, showCompare()
     else:
-        return year, showGraphs(dataset)
+        return year, showGraphs(dataset, start, end)
 
 
 def getDataset(data):
@@ -263,15 +468,91 @@ def getDataset(data):
 @app.callback(
     Output("schools_div", "children"),
     [Input("filter_schools", "value"),
-     Input('year_store', 'data')]
+     Input('year_store', 'data')],
+    [State('date_range', 'start_date'),
+     State('date_range', 'end_date')]
+)
+def updateSchoolsFilter(schools, year, start=None, end=None):
+    dataset = getDataset(year)
+    return updateSchools(dataset, schools, start, end)
+
+
+@app.callback(
+    Output({'type': 'totals_graph', 'kind': MATCH}, 'figure'),
+    [Input({'type': 'totals_graph', 'kind': MATCH}, 'id')],
+    [State('year_store', 'data'),
+     State('date_range', 'start_date'),
+     State('date_range', 'end_date')]
+)
+def updateTotalsGraph(graph_id, year, start=None, end=None):
+    dataset = getDataset(year)
+    return getDatasetFigure(dataset['id'], graph_id['kind'], start, end)
+
+
+@app.callback(
+    Output({'type': 'totals_mode_graph_base', 'kind': MATCH}, 'data'),
+    [Input({'type': 'totals_mode_graph_base', 'kind': MATCH}, 'id')],
+    [State('year_store', 'data'),
+     State('date_range', 'start_date'),
+     State('date_range', 'end_date')]
 )
-def updateSchoolsFilter(schools, year):
+def updateTotalsModeGraph(base_id, year, start=None, end=None):
     dataset = getDataset(year)
-    return updateSchools(dataset, schools)
+    return getDatasetFigure(dataset['id'], base_id['kind'], start, end)
+
+
+app.clientside_callback(
+    ClientsideFunction(namespace='modes', function_name='applyMode'),
+    Output({'type': 'totals_mode_graph', 'kind': MATCH}, 'figure'),
+    [Input({'type': 'totals_mode_graph_mode', 'kind': MATCH}, 'value'),
+     Input({'type': 'totals_mode_graph_base', 'kind': MATCH}, 'data')]
+)
+
+app.clientside_callback(
+    ClientsideFunction(namespace='modes', function_name='applyMode'),
+    Output({'type': 'school_mode_graph', 'kind': MATCH, 'school': MATCH}, 'figure'),
+    [Input({'type': 'school_mode_graph_mode', 'kind': MATCH, 'school': MATCH}, 'value'),
+     Input({'type': 'school_mode_graph_base', 'kind': MATCH, 'school': MATCH}, 'data')]
+)
+
+
+app.clientside_callback(
+    ClientsideFunction(namespace='map', function_name='applyRange'),
+    Output('map', 'figure'),
+    [Input('map_range', 'value'),
+     Input('map_base', 'data')]
+)
 
 
+def warmUp(schools=True):
+    """Builds everything the first visitors after new data would otherwise
+    all be waiting on: the Totals, Map and Compare pages of every
+    dataset and, with schools, the figures of every school."""
+    for dataset in datasets.values():
+        showGraphs(dataset)
+        buildFigures([partial(getDatasetFigure, dataset['id'], kind)
+                      for _, kind in totals_graphs])
+        showMap(dataset)
+        if schools:
+            _, plots = getDataPlots(dataset)
+            buildFigures([partial(getSchoolFigure, dataset['id'], school, kind)
+                          for school in getRenderedSchools(plots) for kind in school_figures])
+    showCompare()
+
+
+# Set OCPS_WARM_UP=1 to have the first worker to start warm the cache before
+# it takes any requests, or run `python app.py warm` once for every worker
+# sharing the cache. The others start right away, waiting on the entries the
+# first one is building as they need them.
+if (os.environ.get('OCPS_WARM_UP', '') not in ('', '0')
+        and cache.add('warm_up@%s@%s' % (deploy_version, getDataFingerprint()), True)):
+    warmUp()
+
 server = app.server
 
 if __name__ == "__main__":
-    app.run_server(debug=True, dev_tools_hot_reload=True)
-    # app.run_server(debug=False, dev_tools_hot_reload=False)
+    if len(sys.argv) > 1 and sys.argv[1] == 'warm':
+        warmUp()
+    else:
+        app.run_server(debug=True, dev_tools_hot_reload=True)
+        # app.run_server(debug=False, dev_tools_hot_reload=False)
@@ -0,0 +1,51 @@
+// Filters the map by a range of dates in the browser. The figure comes with
+// the running total of every school in layout.meta (see getMapMeta in
+// plots.py) so the cases within the range are the difference of two totals.
+
+// Running total on the day, from the days it changed on and the totals
+function totalOn(days, totals, day) {
+    var low = 0, high = days.length;
+    while (low < high) {
+        var mid = (low + high) >> 1;
+        if (days[mid] <= day) {
+            low = mid + 1;
+        } else {
+            high = mid;
+        }
+    }
+    return low ? totals[low - 1] : 0;
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    map: {
+        applyRange: function (range, base) {
+            if (!base) {
+                return window.dash_clientside.no_update;
+            }
+            var meta = base.layout.meta;
+            var max = 0;
+            var data = base.data.map(function (trace, t) {
+                var confirmed = meta.days[t].map(function (days, i) {
+                    var totals = meta.cumulative[t][i];
+                    return totalOn(days, totals, range[1]) -
+                        totalOn(days, totals, range[0] - 1);
+                });
+                confirmed.forEach(function (count) {
+                    max = Math.max(max, count);
+                });
+                return Object.assign({}, trace, {
+                    marker: Object.assign({}, trace.marker, {size: confirmed}),
+                    customdata: trace.customdata.map(function (row, i) {
+                        return [row[0], confirmed[i]];
+                    })
+                });
+            });
+            // The same scale plotly express uses for size_max
+            data.forEach(function (trace) {
+                trace.marker.sizeref = Math.max(max, 1) /
+                    (meta.size_max * meta.size_max);
+            });
+            return {data: data, layout: base.layout};
+        }
+    }
+});
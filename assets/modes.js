@@ -0,0 +1,83 @@
+// Switches figures built with OCPS_CLIENT_MODES between their modes in the
+// browser. The server only sends the first mode, the daily counts or the
+// counts by school, along with the enrollment to divide them by in
+// layout.meta (see getModesMeta in plots.py), and every other mode is
+// computed from those here.
+
+// Plain array from either a list or one of plotly's base64 typed arrays
+function toArray(values) {
+    if (values && values.bdata !== undefined) {
+        var bytes = Uint8Array.from(atob(values.bdata), function (c) {
+            return c.charCodeAt(0);
+        });
+        var Type = values.dtype === 'i4' ? Int32Array : Float64Array;
+        return Array.from(new Type(bytes.buffer));
+    }
+    return values || [];
+}
+
+function perCapita(count, enrollment) {
+    // Same as perCapita in data.py, nothing where the enrollment is unknown
+    return enrollment > 0 ? count / enrollment : null;
+}
+
+function runningTotal(values) {
+    // Like pandas' cumsum, skipping over missing values
+    var total = 0;
+    return values.map(function (value) {
+        if (value === null || isNaN(value)) {
+            return null;
+        }
+        total += value;
+        return total;
+    });
+}
+
+var transforms = {
+    identity: function (counts) {
+        return counts;
+    },
+    cumulative: function (counts) {
+        return runningTotal(counts);
+    },
+    per_capita: function (counts, enrollment) {
+        return counts.map(function (count, i) {
+            return perCapita(count, enrollment[i]);
+        });
+    },
+    cumulative_per_capita: function (counts, enrollment) {
+        return runningTotal(transforms.per_capita(counts, enrollment));
+    },
+};
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    modes: {
+        applyMode: function (transform, base) {
+            if (!base) {
+                return window.dash_clientside.no_update;
+            }
+            var meta = base.layout.meta;
+            var key = meta.axis.charAt(0);
+            var shared = toArray(meta.enrollment);
+            var tickformat = '.0';
+            meta.modes.forEach(function (mode) {
+                if (mode[1] === transform) {
+                    tickformat = mode[2];
+                }
+            });
+
+            var data = base.data.map(function (trace, i) {
+                var enrollment = meta.trace_enrollment ?
+                    toArray(meta.trace_enrollment[i]) : shared;
+                var copy = Object.assign({}, trace);
+                copy[key] = transforms[transform](toArray(trace[key]), enrollment);
+                return copy;
+            });
+            var layout = Object.assign({}, base.layout);
+            layout[meta.axis] = Object.assign({}, layout[meta.axis], {
+                tickformat: tickformat
+            });
+            return {data: data, layout: layout};
+        }
+    }
+});
@@ -0,0 +1,201 @@
+"""Benchmarks for the pandas hot paths in data.py and plots.py.
+
+Times loading a dataset and every public Data getter and Plots method on
+synthetic data (see synthetic.py), along with the peak memory each one
+allocates, and writes the results as json so runs can be compared:
+
+    python benchmark.py --schools 500 --days 180 --years 3 --json after.json
+    python benchmark.py --compare before.json
+
+    python benchmark.py --per-capita
+"""
+import argparse
+import json
+import platform
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from data import Data, feather, perCapita
+from plots import Plots
+import synthetic
+
+
+def syntheticDaily(schools=500, years=3, seed=0):
+    """Daily confirmed cases and enrollment for every school.
+
+    A few schools get a zero or a missing enrollment so the per capita
+    edge cases are part of every run.
+    """
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range('2020-08-10', periods=365*years)
+    locations = ['School %d' % i for i in range(schools)]
+    enrollment = rng.integers(300, 3000, schools).astype(float)
+    enrollment[::50] = 0
+    enrollment[1::50] = np.nan
+
+    df = pd.DataFrame({
+        'date': np.repeat(dates, schools),
+        'location': np.tile(locations, len(dates)),
+        'confirmed': rng.poisson(.2, len(dates)*schools),
+        'total': np.tile(enrollment, len(dates)),
+    })
+    return df
+
+
+def bestOf(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter()-start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def benchPerCapita(schools=500, years=3, repeat=3):
+    df = syntheticDaily(schools, years)
+
+    def rowWise():
+        # The old code raised ZeroDivisionError on a zero enrollment, guard
+        # it here so it runs over the same rows.
+        return df.apply(lambda row: row.confirmed/row.total
+                        if row.total else np.nan, axis=1)
+
+    def vectorized():
+        return perCapita(df.confirmed, df.total)
+
+    # The row-wise version is slow enough that one run is plenty
+    old, expected = bestOf(rowWise, 1)
+    new, result = bestOf(vectorized, repeat)
+
+    valid = df.total > 0
+    pd.testing.assert_series_equal(
+        result[valid], expected[valid], check_names=False)
+    assert result[~valid].isna().all()
+
+    print("per capita, %d schools x %d years (%d rows)" %
+          (schools, years, len(df)))
+    print("  row-wise apply: %8.3fs" % old)
+    print("  vectorized:     %8.3fs" % new)
+    print("  speedup:        %8.0fx" % (old/new))
+
+
+def measure(fn, repeat):
+    seconds, _ = bestOf(fn, repeat)
+    # Measured in a separate run, tracing allocations slows everything down
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'seconds': seconds, 'peak_bytes': peak}
+
+
+def loading(dataset, snapshot=True, compact=False):
+    return lambda: Data(dataset, snapshot, compact)
+
+
+def runSuite(schools, days, years, repeat=3, compact=False):
+    results = {}
+    with tempfile.TemporaryDirectory() as out_dir:
+        datasets = synthetic.writeDatasets(out_dir, schools, days, years)
+        dataset = datasets[0]
+
+        results['Data(csv)'] = measure(loading(dataset, False, compact), repeat)
+        data = Data(dataset, snapshot=False, compact=compact)
+        if feather is not None:
+            data.writeSnapshot()
+            results['Data(snapshot)'] = measure(
+                loading(dataset, True, compact), repeat)
+
+        school = data.getLocationsList()[0]
+        level = data.getLevelForSchool(school)
+        benchmarks = {
+            'getLatestDate': data.getLatestDate,
+            'getLocationsList': data.getLocationsList,
+            'getSchoolStudentCount': lambda: data.getSchoolStudentCount(school),
+            'getTotalStudentCount': data.getTotalStudentCount,
+            'getTotalStudentCountByLevel': lambda: data.getTotalStudentCountByLevel(level),
+            'getTotalsForSchool': lambda: data.getTotalsForSchool(school),
+            'getDfTotalsByLocation': data.getDfTotalsByLocation,
+            'getTotalConfirmedCases': data.getTotalConfirmedCases,
+            'getTotalEmployeeCases': data.getTotalEmployeeCases,
+            'getTotalStudentCases': data.getTotalStudentCases,
+            'getTotalVendorVisitorCases': data.getTotalVendorVisitorCases,
+            'getLevelForSchool': lambda: data.getLevelForSchool(school),
+            'getRollingRate': data.getRollingRate,
+            'window(last_days=30)': lambda: data.window(last_days=30),
+        }
+        plots = Plots(data)
+        results['Plots'] = measure(lambda: Plots(data), repeat)
+        benchmarks.update({
+            'plotByType': plots.plotByType,
+            'plotByLevel': plots.plotByLevel,
+            'plotBySchool': lambda: plots.plotBySchool(school),
+            'plotRollingRate': plots.plotRollingRate,
+            'plotMap': plots.plotMap,
+            'plotDistributionsForSchool': lambda: plots.plotDistributionsForSchool(school),
+            'plotDistributionByLevel': lambda: plots.plotDistributionByLevel(level),
+            'plotDistribution': plots.plotDistribution,
+        })
+        for name, fn in benchmarks.items():
+            results[name] = measure(fn, repeat)
+
+    return {
+        'scale': {'schools': schools, 'days': days, 'years': years,
+                  'rows': len(data.df), 'compact': compact},
+        'memory': {name: int(size) for name, size in data.memoryReport().items()},
+        'versions': {'python': platform.python_version(),
+                     'pandas': pd.__version__, 'numpy': np.__version__},
+        'results': results,
+    }
+
+
+def printReport(report, baseline=None):
+    print("%(schools)d schools x %(days)d days x %(years)d years "
+          "(%(rows)d case rows)" % report['scale'])
+    if 'memory' in report:
+        print("  %-30s %10.1fMB" % (
+            "Data held in memory", sum(report['memory'].values())/2**20))
+    for name, result in report['results'].items():
+        line = "  %-30s %10.4fs %10.1fMB" % (
+            name, result['seconds'], result['peak_bytes']/2**20)
+        if baseline is not None and name in baseline['results']:
+            line += "  %6.2fx" % (
+                baseline['results'][name]['seconds']/result['seconds'])
+        print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--schools', type=int, default=200)
+    parser.add_argument('--days', type=int, default=180)
+    parser.add_argument('--years', type=int, default=2)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', help="write the report to this file")
+    parser.add_argument('--compare', help="a previous report to compare to, "
+                        "speedups over it are printed next to each result")
+    parser.add_argument('--compact', action='store_true',
+                        help="load the data as compactFrame makes it")
+    parser.add_argument('--per-capita', action='store_true',
+                        help="only run the per capita benchmark")
+    args = parser.parse_args()
+
+    if args.per_capita:
+        benchPerCapita()
+    else:
+        baseline = None
+        if args.compare:
+            with open(args.compare) as f:
+                baseline = json.load(f)
+        report = runSuite(args.schools, args.days, args.years, args.repeat,
+                          args.compact)
+        printReport(report, baseline)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(report, f, indent=2)
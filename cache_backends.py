@@ -0,0 +1,196 @@
+"""Cache backends for flask_caching, picked with CACHE_TYPE in app.py.
+
+flask_caching's filesystem cache prunes by deleting every third file once
+it's over its threshold, whatever was used last. `lruFilesystem` keeps
+the files that are being read instead: every hit bumps the file's mtime
+and pruning removes the least recently used ones first.
+
+`twoTier` puts a per-process LRU of live objects in front of a shared
+cache, the filesystem or redis, so that hot figures and pages are served
+without reading or unpickling anything. Hits and misses are counted per
+tier in /metrics.
+"""
+from collections import OrderedDict
+import os
+import threading
+from time import time
+
+from flask_caching.backends.base import BaseCache
+from flask_caching.backends.filesystemcache import FileSystemCache
+from werkzeug.utils import import_string
+
+import metrics
+
+
+class LRUFileSystemCache(FileSystemCache):
+    # Pruning goes down to this share of the threshold, so that it doesn't
+    # have to list the whole directory again on the next set
+    prune_to = 0.8
+
+    def get(self, key):
+        value = super().get(key)
+        if value is not None:
+            try:
+                os.utime(self._get_filename(key))
+            except OSError:
+                pass
+        return value
+
+    def add(self, key, value, timeout=None):
+        """Adds the key only when it isn't there, atomically: coalesce.leased
+        takes its leases with this. The value is written under a key of
+        its own and then linked into place, which fails if the file exists.
+        """
+        tmp_key = '%s@%d@%d' % (key, os.getpid(), threading.get_ident())
+        if not self.set(tmp_key, value, timeout):
+            return False
+        tmp = self._get_filename(tmp_key)
+        try:
+            for _ in range(2):
+                try:
+                    os.link(tmp, self._get_filename(key))
+                    return True
+                except FileExistsError:
+                    # Left by a worker that died, say. Two workers could both
+                    # get through here, which only means building twice.
+                    if self.get(key) is not None:
+                        break
+                    try:
+                        os.remove(self._get_filename(key))
+                        self._update_count(delta=-1)
+                    except OSError:
+                        pass
+                except OSError:
+                    break
+            self._update_count(delta=-1)
+            return False
+        finally:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+    def _prune(self):
+        if self._threshold == 0 or not self._file_count > self._threshold:
+            return
+
+        entries = []
+        for fname in self._list_dir():
+            try:
+                entries.append((os.path.getmtime(fname), fname))
+            except OSError:
+                pass
+        entries.sort()
+        for _, fname in entries[:max(len(entries)-int(self._threshold*self.prune_to), 0)]:
+            try:
+                os.remove(fname)
+            except OSError:
+                pass
+        # cachelib lists the directory lazily
+        self._update_count(value=len(list(self._list_dir())))
+
+
+def lruFilesystem(app, config, args, kwargs):
+    args.insert(0, config["CACHE_DIR"])
+    kwargs.update(
+        dict(
+            threshold=config["CACHE_THRESHOLD"],
+            ignore_errors=config["CACHE_IGNORE_ERRORS"],
+        )
+    )
+    return LRUFileSystemCache(*args, **kwargs)
+
+
+class TwoTierCache(BaseCache):
+    """Keeps the last `threshold` values it saw in memory, in front of the
+    shared cache that holds everything.
+
+    Values in memory are handed out as they are rather than copied, callers
+    mustn't change them.
+    """
+
+    def __init__(self, shared, threshold=200, default_timeout=300):
+        super().__init__(default_timeout)
+        self.shared = shared
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (expires, value)
+
+    def remember(self, key, value, timeout):
+        timeout = self._normalize_timeout(timeout)
+        expires = time()+timeout if timeout else 0
+        with self.lock:
+            self.entries[key] = (expires, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.threshold:
+                self.entries.popitem(last=False)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] and entry[0] < time():
+                del self.entries[key]
+                entry = None
+            if entry is not None:
+                self.entries.move_to_end(key)
+        if entry is not None:
+            metrics.count('memory_tier', 'hit')
+            return entry[1]
+        metrics.count('memory_tier', 'miss')
+
+        value = self.shared.get(key)
+        metrics.count('shared_tier', 'miss' if value is None else 'hit')
+        if value is not None:
+            # The shared tier doesn't say how long the value has left, it's
+            # kept here for the default timeout at most
+            self.remember(key, value, None)
+        return value
+
+    def set(self, key, value, timeout=None):
+        self.remember(key, value, timeout)
+        return self.shared.set(key, value, timeout)
+
+    def add(self, key, value, timeout=None):
+        if not self.shared.add(key, value, timeout):
+            return False
+        self.remember(key, value, timeout)
+        return True
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+        return self.shared.delete(key)
+
+    def has(self, key):
+        with self.lock:
+            if key in self.entries:
+                return True
+        return self.shared.has(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+        return self.shared.clear()
+
+
+def getFactory(cache_type):
+    """Resolves a CACHE_TYPE the way Cache._set_cache does: plain names are
+    classes in flask_caching.backends, like RedisCache, and backend classes
+    are built by their factory classmethod. The lowercase names, like redis,
+    are gone from flask_caching 2."""
+    if "." not in cache_type:
+        cache_type = "flask_caching.backends." + cache_type
+    factory = import_string(cache_type)
+    if isinstance(factory, type) and issubclass(factory, BaseCache):
+        factory = factory.factory
+    return factory
+
+
+def twoTier(app, config, args, kwargs):
+    """CACHE_SHARED_TYPE names the shared tier like CACHE_TYPE would, it gets
+    the rest of the config. CACHE_MEMORY_THRESHOLD is the number of values
+    kept in memory."""
+    shared = getFactory(config["CACHE_SHARED_TYPE"])(
+        app, config, list(args), dict(kwargs))
+    return TwoTierCache(shared, config["CACHE_MEMORY_THRESHOLD"],
+                        kwargs["default_timeout"])
@@ -0,0 +1,94 @@
+"""Request coalescing for the memoized functions in app.py.
+
+flask_caching's memoize has no notion of a call in progress: when a key is
+missing, after the cache is cleared or an entry expires, every request that
+arrives before the first one finishes builds the same value. `coalesced`
+lets one caller per key through and makes the others wait for its result.
+
+That is per process. `leased` does the same across the workers sharing a
+cache, with a lease taken in the cache itself: the first worker to miss
+builds the value and the others wait for it to turn up in the cache.
+"""
+from functools import wraps
+import threading
+import time
+
+import metrics
+
+
+class Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.failed = False
+
+
+def coalesced(fn):
+    """Runs at most one call of fn at a time for the same arguments, the
+    callers that arrive meanwhile get the same result. Goes on top of the
+    cache decorator."""
+    lock = threading.Lock()
+    flights = {}
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        # The arguments include dicts, which can't be hashed
+        key = repr((args, sorted(kwargs.items())))
+        with lock:
+            flight = flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = flights[key] = Flight()
+
+        if not leader:
+            metrics.count(fn.__name__, 'coalesced')
+            flight.done.wait()
+            if not flight.failed:
+                return flight.result
+            # Have a go ourselves rather than share the leader's exception
+            return fn(*args, **kwargs)
+
+        try:
+            flight.result = fn(*args, **kwargs)
+            return flight.result
+        except BaseException:
+            flight.failed = True
+            raise
+        finally:
+            with lock:
+                del flights[key]
+            flight.done.set()
+    return wrapper
+
+
+# Seconds a lease is held at most, after that the waiting workers build the
+# value themselves in case the worker holding it died
+lease_timeout = 60
+poll_interval = 0.05
+
+
+def leased(cache, key, build, name='lease'):
+    """The value at key in cache or, when it's missing, build(), which has
+    to store it there. Only one process at a time builds it, the others poll
+    the cache for it meanwhile.
+
+    The lease is an add() to the cache, atomic with redis; the filesystem
+    cache can now and then let two workers through.
+    """
+    value = cache.get(key)
+    if value is not None:
+        return value
+    lease = key + ':lease'
+    deadline = time.time() + lease_timeout
+    while not cache.add(lease, True, timeout=lease_timeout):
+        metrics.count(name, 'leased')
+        time.sleep(poll_interval)
+        value = cache.get(key)
+        if value is not None:
+            return value
+        if time.time() > deadline:
+            break
+    try:
+        return build()
+    finally:
+        cache.delete(lease)
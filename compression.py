@@ -0,0 +1,140 @@
+"""Compression and a response cache for the Dash callbacks.
+
+Turned on by setting OCPS_COMPRESS=1 in the environment. Responses to
+_dash-update-component are then gzipped, or compressed with brotli when
+the brotli package is installed and the browser accepts it.
+
+Every callback's output depends only on its request, the data and the
+deployment: the code and the OCPS_ settings. The last `max_responses`
+compressed bodies are kept by the hash of those, so a repeat of a recent
+request, from any visitor, is answered without running the callback or
+compressing again.
+
+Dash sends callbacks as POST requests, which browsers neither cache nor
+revalidate, so there are no ETags or 304s; those would need the callbacks
+served over GET.
+"""
+from collections import OrderedDict
+import gzip
+import hashlib
+import os
+import threading
+
+import metrics
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, we fall back to gzip
+    brotli = None
+
+enabled = os.environ.get('OCPS_COMPRESS', '') not in ('', '0')
+
+max_responses = 100
+# Bodies smaller than this aren't worth compressing
+min_size = 500
+
+
+def getEncoding(accept_encodings):
+    if brotli is not None and 'br' in accept_encodings:
+        return 'br'
+    if 'gzip' in accept_encodings:
+        return 'gzip'
+    return None
+
+
+def compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=5)
+    return gzip.compress(body, compresslevel=6)
+
+
+# Settings that change how the app serves or keeps what it builds, but not
+# what it builds
+serving_settings = ['OCPS_CACHE_CONTENT_HASH', 'OCPS_CACHE_MEMORY_SIZE',
+                    'OCPS_CACHE_REDIS_URL', 'OCPS_CACHE_SIZE', 'OCPS_COMPRESS',
+                    'OCPS_FIGURE_WORKERS', 'OCPS_METRICS', 'OCPS_WARM_UP']
+
+
+def getDeployVersion():
+    """Hash of the code and assets next to this file and of the OCPS_
+    settings, anything that changes the callbacks' output on a restart.
+
+    Leaves out serving_settings, so that `python app.py warm` builds the
+    same entries as the workers it warms the cache for."""
+    root = os.path.dirname(os.path.abspath(__file__))
+    h = hashlib.sha1()
+    for directory in [root, os.path.join(root, 'assets')]:
+        if not os.path.isdir(directory):
+            continue
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if name.endswith(('.py', '.js', '.css')) and os.path.isfile(path):
+                with open(path, 'rb') as f:
+                    h.update(name.encode() + f.read())
+    h.update(repr(sorted((key, value) for key, value in os.environ.items()
+                         if key.startswith('OCPS_') and key not in serving_settings)).encode())
+    return h.hexdigest()
+
+
+def register(server, version):
+    """Compresses callback responses on server. version returns a
+    fingerprint of what the callbacks read while running, the data and any
+    other files."""
+    if not enabled:
+        return
+    from flask import Response, g, request
+
+    deploy_version = getDeployVersion()
+
+    lock = threading.Lock()
+    responses = OrderedDict()  # (key, accepted encoding) -> (body, encoding)
+
+    def isCallback():
+        return request.method == 'POST' and request.path.endswith('_dash-update-component')
+
+    def getCached(key):
+        with lock:
+            cached = responses.get(key)
+            if cached is not None:
+                responses.move_to_end(key)
+            return cached
+
+    def keep(key, cached):
+        with lock:
+            responses[key] = cached
+            while len(responses) > max_responses:
+                responses.popitem(last=False)
+
+    def respond(body, encoding):
+        response = Response(body, mimetype='application/json')
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+        response.headers['Vary'] = 'Accept-Encoding'
+        return response
+
+    @server.before_request
+    def serveCached():
+        if not isCallback():
+            return None
+        g.response_key = hashlib.sha1((deploy_version+version()).encode() +
+                                      request.get_data()).hexdigest()
+        g.encoding = getEncoding(request.accept_encodings)
+        cached = getCached((g.response_key, g.encoding))
+        if cached is not None:
+            metrics.count('responses', 'hit')
+            g.cached = True
+            return respond(*cached)
+        return None
+
+    @server.after_request
+    def compressResponse(response):
+        if ('response_key' not in g or g.get('cached') or response.status_code != 200
+                or response.direct_passthrough):
+            return response
+        metrics.count('responses', 'miss')
+        body = response.get_data()
+        encoding = g.encoding if len(body) >= min_size else None
+        if encoding is not None:
+            body = compress(body, encoding)
+        keep((g.response_key, g.encoding), (body, encoding))
+        return respond(body, encoding)
@@ -1,20 +1,44 @@
+from contextlib import contextmanager
 from datetime import datetime
-
+from functools import lru_cache
+import copy
+import hashlib
+import io
+import json
+import os
+import sys
+
+import numpy as np
 import pandas as pd
 
+import metrics
+
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+except ImportError:  # Snapshots are optional, we fall back to the csv files
+    feather = None
+
 d20212022 = {
+    'id': 'd20212022',
+    'name': '2021-2022',
     'file': 'data/2021-2022-cases.csv',
     'directory': 'data/directory.csv',
     'demographics': 'data/demographics.csv',
+    'snapshot': 'data/2021-2022',
     'cutoff': datetime(2021, 8, 2)
 }
 d20202021 = {
+    'id': 'd20202021',
+    'name': '2020-2021',
     'file': 'data/2020-2021-cases.csv',
     'directory': 'data/directory.csv',
     'demographics': 'data/demographics.csv',
+    'snapshot': 'data/2020-2021',
     'start_date': datetime(2021, 8, 1),
     'cutoff': datetime(2020, 8, 21)
 }
+datasets = {d['id']: d for d in [d20212022, d20202021]}
 
 df_to_dir_map = {
     'LAKECOMO': 'LAKECOMOSCHOOL',
@@ -41,18 +65,22 @@ df_to_demo_map = {
 }
 
 
-def mapDirNames(name, name_map):
+# Removed in this order, before the single characters below, so that
+# 'K-8' and 'ST.' still match before '-' and '.' are stripped.
+name_removals = ['K-8', 'ST.', 'SCHOOLS', 'SCHOOL']
+name_translation = str.maketrans('', '', "()’-. ")
+
+
+@lru_cache(maxsize=None)
+def normalizeName(name):
     name = name.upper()
-    name = name.replace('K-8', '')
-    name = name.replace("ST.", "")
-    name = name.replace('SCHOOLS', '')
-    name = name.replace('SCHOOL', '')
-    name = name.replace('(', '')
-    name = name.replace(')', '')
-    name = name.replace("’", "")
-    name = name.replace("-", "")
-    name = name.replace(".", "")
-    name = name.replace(' ', '')
+    for s in name_removals:
+        name = name.replace(s, '')
+    return name.translate(name_translation)
+
+
+def mapDirNames(name, name_map):
+    name = normalizeName(name)
 
     if name in name_map:
         return name_map[name]
@@ -60,41 +88,652 @@ def mapDirNames(name, name_map):
     return name.strip()
 
 
-class Data:
-    def __init__(self, dataset):
-        self.dataset = dataset
-        df = pd.read_csv(dataset['file'])
-        df['date'] = df['date'].apply(pd.to_datetime)
-        df['count'] = df['count'].apply(pd.to_numeric)
+def mapDirNamesColumn(column, name_map):
+    # Only a few hundred distinct names appear across hundreds of thousands
+    # of rows, so normalize each unique value once and broadcast back.
+    codes, uniques = pd.factorize(column)
+    mapped = np.array([mapDirNames(x, name_map) for x in uniques] + [None],
+                      dtype=object)
+    return pd.Series(mapped[codes], index=column.index, name=column.name)
 
-        dir_df = pd.read_csv(dataset['directory'])
 
-        demo_df = pd.read_csv(dataset['demographics'], usecols=[
-                              'date', 'location', 'total'])
-        demo_df['date'] = demo_df['date'].apply(pd.to_datetime)
+class LocationIndex:
+    """Canonical join keys for every location in the cases file.
 
-        df['location_map'] = df.location.apply(
-            lambda x: mapDirNames(x, df_to_dir_map))
-        demo_df['location_map'] = demo_df.location.apply(
-            lambda x: mapDirNames(x, df_to_demo_map))
-        del demo_df['location']
-        dir_df['location_map'] = dir_df.location.apply(
-            lambda x: mapDirNames(x, df_to_dir_map))
+    Built once per load from the unique case locations and shared by the
+    directory and demographics joins, so neither has to go through the full
+    cases frame to find its keys.
+    """
 
-        demo_df = pd.merge(
-            demo_df, df[['location', 'location_map']], on='location_map')
+    def __init__(self, locations):
+        keys = pd.DataFrame({'location': pd.unique(locations)})
+        keys['location_map'] = mapDirNamesColumn(keys.location, df_to_dir_map)
+        self.keys = keys
+
+    def joinDemographics(self, demo_df):
+        demo_df = demo_df.copy()
+        demo_df['location_map'] = mapDirNamesColumn(
+            demo_df.location, df_to_demo_map)
+        del demo_df['location']
+        demo_df = pd.merge(demo_df, self.keys, on='location_map')
         del demo_df['location_map']
+        return demo_df
+
+    def joinDirectory(self, df, dir_df):
+        dir_df = dir_df.copy()
+        dir_df['location_map'] = mapDirNamesColumn(
+            dir_df.location, df_to_dir_map)
+        locations = self.keys.merge(dir_df, how='left', on='location_map')
+        locations.rename(columns={'location_x': 'location'}, inplace=True)
+        return df.merge(locations, how='left', on='location')
+
+
+# Columns stored dictionary encoded in the snapshot files
+snapshot_categories = ['location', 'level', 'type']
+
+# Keep Data.df as compactFrame makes it, see there
+compact_data = os.environ.get('OCPS_COMPACT_DATA', '') not in ('', '0')
+
+# The columns of Data.df the getters and plots use
+data_columns = ['date', 'location', 'type', 'confirmed', 'level', 'lat', 'long']
+
+
+def compactFrame(df):
+    """The cases with only data_columns, the low cardinality strings as
+    categoricals and the counts as 32 bit integers.
+
+    Takes a fraction of the memory of the joined frame, which every worker
+    holds for every year. Grouping by the categoricals needs observed=True
+    so that only the combinations that occur come out.
+
+    The rows getPlottedDf would drop for a missing value in any of the
+    other columns are marked in `plotted` first, so the plots are the same.
+    """
+    plotted = df.drop(columns='plotted', errors='ignore').notna().all(axis=1)
+    if 'plotted' in df:
+        # Rows compacted before, refresh() appends to them, keep their mark
+        plotted = df.plotted.where(df.plotted.notna(), plotted).astype(bool)
+    df = df[[col for col in data_columns if col in df]].copy()
+    df['plotted'] = plotted
+    for col in snapshot_categories:
+        if col in df:
+            # Sorted categories sort the same as the strings would
+            values = df[col].astype('category')
+            df[col] = values.cat.reorder_categories(
+                values.cat.categories.sort_values())
+    if not df.confirmed.isna().any():
+        df['confirmed'] = df.confirmed.astype('int32')
+    return df
+
+
+def getSourceFiles(dataset):
+    return [dataset['file'], dataset['directory'], dataset['demographics']]
+
+
+def getSnapshotFiles(dataset):
+    prefix = dataset['snapshot']
+    return prefix + '-cases.feather', prefix + '-demographics.feather'
+
+
+def getSourceStamp(dataset):
+    return tuple(os.path.getmtime(f) for f in getSourceFiles(dataset))
+
+
+content_hashes = {}
+
+
+def getContentHash(dataset):
+    """sha256 of the dataset's source files.
+
+    Only re-hashed when one of the files' mtime changes.
+    """
+    stamp = getSourceStamp(dataset)
+    cached = content_hashes.get(dataset['id'])
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+
+    h = hashlib.sha256()
+    for f in getSourceFiles(dataset):
+        with open(f, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(1 << 20), b''):
+                h.update(chunk)
+    content_hashes[dataset['id']] = (stamp, h.hexdigest())
+    return h.hexdigest()
+
+
+def getFingerprint(dataset, content=False):
+    """Identifies the data a dataset is built from: the size and mtime of
+    each source file or, with content, the hash of what's in them."""
+    if content:
+        return getContentHash(dataset)
+    fingerprint = []
+    for f in getSourceFiles(dataset):
+        st = os.stat(f)
+        fingerprint.append((st.st_size, st.st_mtime_ns))
+    return tuple(fingerprint)
+
+
+def isSnapshotFresh(dataset):
+    if feather is None or 'snapshot' not in dataset:
+        return False
+    try:
+        built = min(os.path.getmtime(f) for f in getSnapshotFiles(dataset))
+        changed = max(getSourceStamp(dataset))
+    except OSError:
+        return False
+    return built > changed
+
+
+@contextmanager
+def replacing(path):
+    """A temporary path to write path's new contents to, moved into place
+    once the block is done, so that readers never see a partial file."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = path + '.tmp'
+    yield tmp
+    os.replace(tmp, path)
+
+
+def writeText(path, text):
+    with replacing(path) as tmp, open(tmp, 'w') as f:
+        f.write(text)
+
+
+def writeFrame(df, path, metadata={}):
+    df = df.reset_index(drop=True)
+    for col in snapshot_categories:
+        if col in df:
+            df[col] = df[col].astype('category')
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    schema_metadata = dict(table.schema.metadata)
+    schema_metadata[b'ocps'] = json.dumps(metadata).encode()
+    table = table.replace_schema_metadata(schema_metadata)
+    with replacing(path) as tmp:
+        feather.write_feather(table, tmp, compression='uncompressed')
+
+
+def readFrame(path):
+    """The frame in a snapshot file and the metadata written with it.
+
+    Uncompressed feather files can be memory mapped, and converted without
+    consolidating the columns into blocks the numeric and date columns stay
+    views of the mapped pages, so workers share them through the OS page
+    cache. The dictionary encoded columns come back as categoricals, only
+    their codes and any other strings are copied.
+    """
+    table = feather.read_table(path, memory_map=True)
+    df = table.to_pandas(split_blocks=True)
+    for col in snapshot_categories:
+        if col in df:
+            # Sorted categories sort the same as the strings would
+            df[col] = df[col].cat.reorder_categories(
+                df[col].cat.categories.sort_values())
+    metadata = json.loads(table.schema.metadata.get(b'ocps', b'{}'))
+    return df, metadata
+
+
+@lru_cache(maxsize=8)
+def readSharedCsvAt(path, mtime, usecols=None):
+    df = pd.read_csv(path, usecols=None if usecols is None else list(usecols))
+    if 'date' in df:
+        df['date'] = pd.to_datetime(df['date'])
+    return df
+
+
+def readSharedCsv(path, usecols=None):
+    """A csv shared by every school year, the directory or demographics,
+    parsed once for as long as the file doesn't change.
+
+    Returns a copy the caller is free to modify.
+    """
+    return readSharedCsvAt(path, os.path.getmtime(path), usecols).copy()
+
+
+def perCapita(cases, enrollment):
+    """Cases divided by enrollment, NaN where the enrollment is 0 or unknown.
+
+    Works on a Series, or on a DataFrame where every column is divided by
+    the enrollment Series aligned on the index.
+    """
+    enrollment = enrollment.where(enrollment > 0)
+    if isinstance(cases, pd.DataFrame):
+        return cases.div(enrollment, axis=0)
+    return cases / enrollment
+
+
+def nearestByDate(series, dates):
+    # Same as merge_asof(direction='nearest') of the dates against series,
+    # which prefers the earlier value when two are equally near.
+    series = series.dropna().sort_index()
+    if series.empty:
+        return pd.Series(np.nan, index=dates)
+    known = series.index.values
+    target = pd.DatetimeIndex(dates).values
+    after = np.searchsorted(known, target, side='left').clip(max=len(known)-1)
+    before = (np.searchsorted(known, target, side='right')-1).clip(min=0)
+    use_after = np.abs(known[after]-target) < np.abs(target-known[before])
+    pos = np.where(use_after, after, before)
+    return pd.Series(series.values[pos], index=dates)
+
+
+class EnrollmentIndex:
+    """Enrollment snapshots with binary search as-of lookups.
+
+    Keeps a sorted array of snapshot dates for every location, and the
+    district and per level totals at every snapshot date, so a lookup never
+    has to go back through the demographics frame.
+    """
+
+    def __init__(self, demo_df, levels):
+        demo_df = demo_df.sort_values(by='date', kind='stable')
+        self.locations = {
+            location: (group.date.values, group.total.values)
+            for location, group in demo_df.groupby('location', sort=False, observed=True)}
+
+        self.dates = np.sort(demo_df.date.unique())
+        self.district = demo_df.groupby('date').total.sum()
+
+        demo_df = demo_df.merge(levels, on='location')
+        self.levels = {
+            level: group.groupby('date').total.sum()
+            for level, group in demo_df.groupby('level', observed=True)}
+
+    def asof(self, location, date):
+        """Latest enrollment of the location on or before the date."""
+        if location not in self.locations:
+            return np.nan
+        dates, totals = self.locations[location]
+        i = np.searchsorted(dates, np.datetime64(date), side='right')-1
+        if i < 0:
+            return np.nan
+        return totals[i]
+
+    def getSnapshotDate(self, date):
+        """Latest snapshot date on or before the date, or None."""
+        i = np.searchsorted(self.dates, np.datetime64(date), side='right')-1
+        if i < 0:
+            return None
+        return self.dates[i]
+
+    def total(self, date, level=None):
+        """Total enrollment at the latest snapshot on or before the date,
+        for the district or for a single level.
+        """
+        snapshot = self.getSnapshotDate(date)
+        totals = self.district if level is None else self.levels.get(level)
+        if snapshot is None or totals is None or snapshot not in totals.index:
+            return 0
+        return totals[snapshot]
+
+
+class DailyCube:
+    """Confirmed cases per day for every (level, type, location).
+
+    Every day between the first and last case is present, and the running
+    totals are materialized alongside the daily counts, so the plots only
+    have to select and sum columns.
+    """
+
+    def __init__(self, df, demo_df):
+        new = self.pivot(df)
+        dates = pd.date_range(new.index.min(), new.index.max())
+        self.new = new.reindex(dates, fill_value=0)
+        self.cum = self.new.cumsum()
+
+        self.demo_totals = demo_df.pivot_table(
+            index='date', columns='location', values='total', aggfunc='sum')
+        self.district_totals = demo_df.groupby('date').total.sum()
+        self.enrollment = nearestByDate(self.district_totals, dates)
+        self.cum_pc = perCapita(self.new, self.enrollment).cumsum()
+
+    def pivot(self, df):
+        return df.pivot_table(index='date', columns=['level', 'type', 'location'],
+                              values='confirmed', aggfunc='sum', fill_value=0, observed=True)
+
+    def extended(self, df):
+        """A copy of the cube with the cases in df added.
+
+        Only the running totals from the first day in df onwards are
+        recomputed.
+        """
+        if df.empty:
+            return self
+        cube = copy.copy(self)
+        delta = self.pivot(df)
+        start = delta.index.min()
+        dates = pd.date_range(min(self.new.index.min(), start),
+                              max(self.new.index.max(), delta.index.max()))
+        columns = self.new.columns.union(delta.columns)
+
+        new = self.new.reindex(index=dates, columns=columns, fill_value=0)
+        cube.new = new + delta.reindex(index=dates, columns=columns, fill_value=0)
+        cube.enrollment = nearestByDate(self.district_totals, dates)
+
+        def runningTotal(old, new):
+            # Days between the last loaded date and start carry the old
+            # running total over
+            before = old.reindex(columns=columns, fill_value=0).reindex(
+                index=dates[dates < start], method='ffill', fill_value=0)
+            after = new.loc[start:].cumsum()
+            if len(before):
+                after = after + before.iloc[-1]
+            return pd.concat([before, after])
+
+        cube.cum = runningTotal(self.cum, cube.new)
+        cube.cum_pc = runningTotal(
+            self.cum_pc, perCapita(cube.new, cube.enrollment))
+        return cube
+
+    def groupColumns(self, df, column):
+        return df.T.groupby(level=column).sum().T
+
+    def select(self, column, location=None):
+        """Daily, cumulative and cumulative per capita cases by `column`.
+
+        Per capita values are relative to the whole district, or to the
+        location's own enrollment when a location is given.
+        """
+        if location is None:
+            return (self.groupColumns(self.new, column),
+                    self.groupColumns(self.cum, column),
+                    self.groupColumns(self.cum_pc, column))
+
+        if location not in self.new.columns.get_level_values('location'):
+            empty = pd.DataFrame(index=self.new.index[:0])
+            return empty, empty, empty
+
+        new = self.groupColumns(
+            self.new.xs(location, level='location', axis=1), column)
+        active = new.index[new.sum(axis=1) != 0]
+        new = new.loc[active.min():active.max()]
+        cum = new.cumsum()
+        cum_pc = perCapita(new, self.getEnrollment(new.index, location)).cumsum()
+        return new, cum, cum_pc
+
+    def rollingRate(self, days, location=None):
+        """Cases in the `days` days up to every day, per student of the
+        district or of the location."""
+        new = self.new
+        if location is not None:
+            new = new.xs(location, level='location', axis=1)
+        cases = new.sum(axis=1).rolling(days, min_periods=days).sum()
+        return perCapita(cases, self.getEnrollment(cases.index, location))
+
+    def getEnrollment(self, dates, location=None):
+        """Enrollment nearest to each of the dates, for the district or for
+        a single location, as used for the per capita running totals."""
+        if location is None:
+            return nearestByDate(self.district_totals, dates)
+        enrollment = pd.Series(dtype=float)
+        if location in self.demo_totals:
+            enrollment = self.demo_totals[location]
+        return nearestByDate(enrollment, dates)
+
+
+class MapAggregate:
+    """Coordinates and running totals of confirmed cases for every school
+    on the map.
+
+    Built from the cube, so the cases within any range of dates are the
+    difference of two rows of `cum` rather than a regroup of the cases.
+    """
+
+    def __init__(self, locations, cube):
+        self.locations = locations
+        cum = cube.cum.T.groupby(level=['level', 'location']).sum().T
+        self.cum = cum.reindex(columns=pd.MultiIndex.from_frame(
+            locations[['level', 'location']]), fill_value=0)
+
+    @staticmethod
+    def getLocations(df):
+        return df[['location', 'level', 'lat', 'long']].drop_duplicates().sort_values(
+            by=['location', 'level', 'lat', 'long'], ignore_index=True)
+
+    def confirmed(self, start=None, end=None):
+        """Confirmed cases at every location, between the dates inclusive
+        when they're given."""
+        dates = self.cum.index.values
+        last = len(dates)-1
+        if end is not None:
+            last = np.searchsorted(dates, np.datetime64(end), side='right')-1
+        first = 0
+        if start is not None:
+            first = np.searchsorted(dates, np.datetime64(start), side='left')
+        if first > last:
+            return np.zeros(len(self.locations), dtype=np.int64)
+        confirmed = self.cum.values[last]
+        if first > 0:
+            confirmed = confirmed - self.cum.values[first-1]
+        return confirmed.astype(np.int64)
+
+
+def countByLocation(df):
+    """Level and confirmed cases, in total and by type, for each location."""
+    locations = df.groupby('location', sort=False, observed=True)
+    counts = pd.DataFrame({'level': locations['level'].first()})
+    # One row per location, small enough for plain strings
+    counts.index = counts.index.astype(object)
+    counts['level'] = counts.level.astype(object)
+    counts['confirmed'] = locations.confirmed.sum()
+
+    by_type = df.pivot_table(index='location', columns='type',
+                             values='confirmed', aggfunc='sum', fill_value=0, observed=True)
+    for typ in ['Employee', 'Student', 'Vendor/Visitor']:
+        counts[typ] = by_type[typ] if typ in by_type else 0
+    return counts
+
+
+class Data:
+    def __init__(self, dataset, snapshot=True, compact=compact_data):
+        self.dataset = dataset
+        self.compact = compact
+        if not (snapshot and isSnapshotFresh(dataset) and self.loadSnapshot()):
+            self.loadCsv()
+        if compact:
+            self.df = compactFrame(self.df)
+        self.buildAggregates()
+
+    @metrics.timed('buildAggregates')
+    def buildAggregates(self):
+        levels = self.df[['location', 'level']].dropna().drop_duplicates()
+        self.enrollment = EnrollmentIndex(self.demo_df, levels)
+        plotted = self.getPlottedDf()
+        self.cube = DailyCube(plotted, self.demo_df)
+        self.map = MapAggregate(MapAggregate.getLocations(plotted), self.cube)
+        self.counts = countByLocation(self.df)
+        self.totals_by_location = self.buildTotalsByLocation()
+        self.summary = self.buildSummary()
+
+    @metrics.timed('loadSnapshot')
+    def loadSnapshot(self):
+        """Returns False for snapshots without what refresh() needs, which
+        were written before it existed and have to be rebuilt."""
+        cases, demographics = getSnapshotFiles(self.dataset)
+        df, metadata = readFrame(cases)
+        if not all(key in metadata for key in ['case_columns', 'cases_offset', 'cases_tail']):
+            return False
+        self.df = df
+        # Written from a compacted frame, refresh() has to keep it that way
+        self.compact = self.compact or 'plotted' in df
+        self.demo_df, _ = readFrame(demographics)
+        self.index = LocationIndex(self.df.location)
+        self.dir_df = None
+        self.case_columns = metadata['case_columns']
+        self.cases_offset = metadata['cases_offset']
+        self.cases_tail = bytes.fromhex(metadata['cases_tail'])
+        return True
+
+    def writeSnapshot(self):
+        if feather is None:
+            raise RuntimeError("pyarrow is not installed, snapshots are disabled")
+        cases, demographics = getSnapshotFiles(self.dataset)
+        writeFrame(self.df, cases, {
+            'case_columns': self.case_columns,
+            'cases_offset': self.cases_offset,
+            'cases_tail': self.cases_tail.hex(),
+        })
+        writeFrame(self.demo_df, demographics)
+
+    def readCases(self, source, **kwargs):
+        df = pd.read_csv(source, **kwargs)
+        df['date'] = pd.to_datetime(df['date'])
+        df['count'] = pd.to_numeric(df['count'])
+        return df
+
+    def getDirectory(self):
+        if self.dir_df is None:
+            self.dir_df = readSharedCsv(self.dataset['directory'])
+        return self.dir_df
+
+    @metrics.timed('loadCsv')
+    def loadCsv(self):
+        dataset = self.dataset
+        # Remember how much of the file was read, so refresh() can pick up
+        # rows appended after this.
+        with open(dataset['file'], 'rb') as f:
+            raw = f.read()
+        # Like refresh(), leave a line that's still being written for later
+        raw = raw[:raw.rfind(b'\n')+1]
+        df = self.readCases(io.BytesIO(raw))
+        self.case_columns = df.columns.tolist()
+        self.cases_offset = len(raw)
+        self.cases_tail = raw[-64:]
+
+        dir_df = readSharedCsv(dataset['directory'])
+        self.dir_df = dir_df
+
+        demo_df = readSharedCsv(dataset['demographics'],
+                                ('date', 'location', 'total'))
+
+        index = LocationIndex(df.location)
+
+        demo_df = index.joinDemographics(demo_df)
         demo_df = demo_df.sort_values(by='date')
         self.demo_df = demo_df.drop_duplicates()
 
-        df = df.merge(dir_df, how='left', on='location_map')
+        df = self.joinCases(index, df, dir_df)
         df = df.sort_values(by='date')
 
-        df.rename(columns={'location_x': 'location',
-                  'total': 'student_count', 'count': 'confirmed'}, inplace=True)
+        self.index = index
+        self.df = df
+
+    def joinCases(self, index, df, dir_df):
+        df = index.joinDirectory(df, dir_df)
+        df.rename(columns={'total': 'student_count',
+                  'count': 'confirmed'}, inplace=True)
         df.drop(['location_map'], axis=1, inplace=True)
+        return df
 
-        self.df = df
+    @metrics.timed('refresh')
+    def refresh(self):
+        """Ingests rows appended to the cases file since it was read.
+
+        Only the new rows are parsed and joined, and the aggregates are
+        updated from them. Returns False when that isn't possible and the
+        dataset needs a full reload instead: the file changed other than by
+        appending, or the new rows bring in locations that weren't loaded
+        (their demographics would have to be joined as well).
+        """
+        with open(self.dataset['file'], 'rb') as f:
+            f.seek(self.cases_offset-len(self.cases_tail))
+            if f.read(len(self.cases_tail)) != self.cases_tail:
+                return False
+            delta = f.read()
+        # Leave a partially written last line for the next refresh
+        delta = delta[:delta.rfind(b'\n')+1]
+        if not delta:
+            return True
+        if not self.cases_tail.endswith(b'\n'):
+            return False
+
+        df = self.readCases(io.BytesIO(delta), header=None,
+                            names=self.case_columns)
+        if not df.location.isin(self.index.keys.location).all():
+            return False
+        df = self.joinCases(self.index, df, self.getDirectory())
+        df = df.sort_values(by='date')
+
+        self.cases_offset += len(delta)
+        self.cases_tail = delta[-64:]
+        self.df = pd.concat([self.df, df], ignore_index=True)
+        if df.date.min() < self.df.date.iloc[-len(df)-1]:
+            self.df = self.df.sort_values(by='date')
+        if self.compact:
+            self.df = compactFrame(self.df)
+
+        self.cube = self.cube.extended(self.getPlottedDf(df))
+        self.map = MapAggregate(self.map.locations, self.cube)
+        counts = self.counts.copy()
+        delta_counts = countByLocation(df).drop(columns='level')
+        counts.loc[delta_counts.index, delta_counts.columns] += delta_counts
+        self.counts = counts
+        self.totals_by_location = self.buildTotalsByLocation()
+        self.summary = self.buildSummary()
+        return True
+
+    def getPlottedDf(self, df=None):
+        # Only cases that matched a school in the directory can be plotted
+        if df is None:
+            df = self.df
+        # df is sorted by date, so the bad dates before 2000 are a prefix
+        df = df.iloc[df.date.searchsorted(datetime(2000, 1, 1)):]
+        if 'plotted' in df:
+            # See compactFrame
+            return df[df.plotted]
+        return df.dropna()
+
+    def getDateSlice(self, start=None, end=None):
+        """Positions in df of the cases between start and end, inclusive."""
+        dates = self.df.date
+        first, last = 0, None
+        if start is not None:
+            first = dates.searchsorted(pd.Timestamp(start), side='left')
+        if end is not None:
+            last = dates.searchsorted(pd.Timestamp(end), side='right')
+        return slice(first, last)
+
+    def window(self, start=None, end=None, last_days=None):
+        """A copy restricted to the cases between start and end, inclusive,
+        or to the last_days days up to end or to the latest case.
+
+        Every getter and the aggregates behind the plots then cover only
+        that window. Raises ValueError when there are no cases in it.
+        """
+        if last_days is not None:
+            if end is None:
+                end = self.getLatestDate()
+            start = pd.Timestamp(end)-pd.Timedelta(days=last_days-1)
+        df = self.df.iloc[self.getDateSlice(start, end)]
+        if self.getPlottedDf(df).empty:
+            raise ValueError("no cases between %s and %s" % (start, end))
+        window = copy.copy(self)
+        window.df = df
+        window.buildAggregates()
+        return window
+
+    def memoryReport(self):
+        """Bytes held by every column of df and by the aggregates built
+        from it, largest first."""
+        report = {}
+        for col, size in self.df.memory_usage(index=False, deep=True).items():
+            report['df.' + col] = size
+        frames = {
+            'demo_df': self.demo_df,
+            'cube.new': self.cube.new,
+            'cube.cum': self.cube.cum,
+            'cube.cum_pc': self.cube.cum_pc,
+            'map.cum': self.map.cum,
+            'counts': self.counts,
+            'totals_by_location': self.totals_by_location,
+            'summary': self.summary,
+        }
+        for name, frame in frames.items():
+            report[name] = frame.memory_usage(deep=True).sum()
+        return pd.Series(report).sort_values(ascending=False)
+
+    def getRollingRate(self, days=14, per=1000, location=None):
+        """Cases in the last `days` days per `per` students, on every day."""
+        return self.cube.rollingRate(days, location)*per
 
     def getLatestDate(self):
         return self.df.date.max().date()
@@ -103,49 +742,58 @@ class Data:
         return self.df.location.sort_values().unique().tolist()
 
     def getSchoolStudentCount(self, school):
-        latest = self.getLatestDate()
-        demo_df = self.demo_df.set_index('date').sort_index()
-        return demo_df[demo_df.location == school].asof(pd.to_datetime(latest)).total
+        return self.enrollment.asof(school, self.getLatestDate())
 
     def getTotalStudentCount(self):
-        latest = pd.to_datetime(self.getLatestDate())
-        demo_df = self.demo_df
-        latest = demo_df[demo_df.date <= latest].date.max()
-        return demo_df[demo_df.date == latest].total.sum()
+        return self.enrollment.total(self.getLatestDate())
 
     def getTotalStudentCountByLevel(self, level):
-        df = self.df
-        demo_df = self.demo_df
-        latest = pd.to_datetime(self.getLatestDate())
-        schools = df[df.level == level].location
-        latest = demo_df[demo_df.date <= latest].date.max()
-        return demo_df[(demo_df.date == latest) & (demo_df.location.isin(schools))].total.sum()
+        return self.enrollment.total(self.getLatestDate(), level)
 
     def getTotalsForSchool(self, school):
-        df = self.df[self.df.location == school]
-        pc = self.getSchoolStudentCount(school)
-        tc = self.getTotalConfirmedCases(df)
-        te = self.getTotalEmployeeCases(df)
-        ts = self.getTotalStudentCases(df)
-        tv = self.getTotalVendorVisitorCases(df)
+        if school not in self.summary.index:
+            return (0, 0, 0, 0, np.nan)
+        row = self.summary.loc[school]
         return (
-            tc, te, ts, tv, pc
+            row.confirmed, row.Employee, row.Student, row['Vendor/Visitor'],
+            row.student_count
         )
 
     def getDfTotalsByLocation(self):
-        df = self.df
+        return self.totals_by_location
+
+    def buildTotalsByLocation(self):
         demo_df = self.demo_df
-        latest = pd.to_datetime(self.getLatestDate())
-        latest = demo_df[demo_df.date <= latest].date.max()
+        latest = self.enrollment.getSnapshotDate(self.getLatestDate())
         demo_df = demo_df[(demo_df.date == latest)][['location', 'total']]
 
-        df = df.groupby(['level', 'location'])['confirmed'].sum().reset_index()
+        df = self.counts.dropna(subset=['level']).reset_index()
+        df = df[['level', 'location', 'confirmed']].sort_values(
+            by=['level', 'location'], ignore_index=True)
 
         df = df.merge(demo_df, on='location')
-        df['confirmed_pc'] = df.apply(
-            lambda row: row.confirmed/row.total, axis=1)
+        df['confirmed_pc'] = perCapita(df.confirmed, df.total)
         return df
 
+    def buildSummary(self):
+        """One row per location with everything the per school view shows,
+        so selecting more schools doesn't mean more passes over df.
+        """
+        summary = self.counts.copy()
+        latest = self.getLatestDate()
+        summary['student_count'] = [
+            self.enrollment.asof(loc, latest) for loc in summary.index]
+        summary['confirmed_pc'] = perCapita(
+            summary.confirmed, summary.student_count)
+
+        # Percentile ranks amongst the schools in the distribution plots
+        ranks = self.totals_by_location.set_index('location')
+        by_level = ranks.groupby('level', observed=True)
+        for col in ['confirmed', 'confirmed_pc']:
+            summary[col+'_rank'] = ranks[col].rank(pct=True)
+            summary[col+'_level_rank'] = by_level[col].rank(pct=True)
+        return summary
+
     def getTotalConfirmedCases(self, df=None):
         if df is None:
             df = self.df
@@ -167,11 +815,61 @@ class Data:
         return df[df.type == 'Vendor/Visitor'].confirmed.sum()
 
     def getLevelForSchool(self, school):
-        df = self.df
-        return df['level'][df.location == school].unique()[0]
+        return self.summary.level[school]
+
+
+class SchoolYears:
+    """The cases of several school years in one frame, partitioned by year.
+
+    Built from Data objects that are already loaded, so nothing is read
+    again. Each year's rows are one contiguous block, in the order the years
+    are given, so a single year is a slice, and `school_day` counts the days
+    since the start of the school year (the dataset's cutoff, or its first
+    case) so the years line up against each other.
+    """
+
+    def __init__(self, years):
+        self.years = years
+        frames = []
+        for year_id, data in years.items():
+            df = data.getPlottedDf()
+            start = data.dataset.get('cutoff', df.date.min())
+            frames.append(df.assign(
+                year=year_id, school_day=(df.date-start).dt.days))
+        df = pd.concat(frames, ignore_index=True)
+        df['year'] = pd.Categorical(df.year, categories=list(years))
+        self.df = df
+
+        codes = df.year.cat.codes.values
+        self.bounds = {}
+        for i, year_id in enumerate(years):
+            self.bounds[year_id] = slice(np.searchsorted(codes, i, side='left'),
+                                         np.searchsorted(codes, i, side='right'))
+
+    def getYear(self, year_id):
+        return self.df.iloc[self.bounds[year_id]]
+
+    def getCasesBySchoolDay(self):
+        """Confirmed cases on every day of the school year, a column per
+        year."""
+        cases = self.df.groupby(['school_day', 'year'], observed=True).confirmed.sum()
+        cases = cases.unstack('year', fill_value=0)
+        days = range(cases.index.min(), cases.index.max()+1)
+        return cases.reindex(index=days, columns=list(self.years), fill_value=0)
+
+
+def buildSnapshots():
+    if feather is None:
+        print("pyarrow is not installed, snapshots are disabled")
+        return
+    for dataset in datasets.values():
+        Data(dataset, snapshot=False).writeSnapshot()
+        print("wrote %s" % dataset['snapshot'])
 
 
 if __name__ == "__main__":
-    d = Data(d20212022)
-    locs = d.getLocationsList()
-    pass
+    if len(sys.argv) > 1 and sys.argv[1] == 'snapshot':
+        buildSnapshots()
+    else:
+        d = Data(d20212022)
+        locs = d.getLocationsList()
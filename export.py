@@ -0,0 +1,215 @@
+"""Exports the dashboard as static files, for any static file server or CDN
+to serve without the app:
+
+    python export.py [directory]
+
+Writes every page of every year to _export/ by default:
+
+    index.html                      redirects to the latest year
+    about.html, compare.html
+    <dataset id>/index.html         Totals
+    <dataset id>/map.html
+    <dataset id>/schools.html       links to the page of each school
+    <dataset id>/schools/<school>.html
+
+The figures go in separate json files next to the pages, which fetch them
+and draw them with the copy of plotly.js written alongside. They are built
+without client_modes, so the mode dropdowns are plotly's own and nothing
+but plotly.js is needed in the browser. Date ranges, the map's slider and
+filtering several schools at once are only in the Dash app.
+"""
+from html import escape
+import json
+import os
+import re
+import sys
+from urllib.parse import quote
+
+import dash_bootstrap_components as dbc
+from plotly.offline import get_plotlyjs
+
+from data import Data, SchoolYears, datasets, writeText
+from plots import (Plots, buildFigures, config, dataset_figures, figureToJson,
+                   getColorForType, plotYearOverYear, school_figures,
+                   serveFigure, totals_graphs)
+from render import getRenderedSchools, summarize
+
+title = "(Unofficial) OCPS Covid Dashboard"
+
+loader = """document.querySelectorAll('[data-figure]').forEach(function (div) {
+    fetch(div.dataset.figure)
+        .then(function (response) { return response.json(); })
+        .then(function (fig) { Plotly.newPlot(div, fig.data, fig.layout, %s); });
+});
+"""
+
+
+def markdownToHtml(text):
+    """Just enough markdown for ABOUT.md: headings, lists, links and
+    paragraphs."""
+    def inline(line):
+        return re.sub(r'\[([^\]]*)\]\(([^)]*)\)',
+                      lambda m: '<a href="%s">%s</a>' % (escape(m.group(2)), m.group(1)),
+                      escape(line, quote=False))
+
+    out = []
+    in_list = False
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith('- ') != in_list:
+            in_list = not in_list
+            out.append('<ul>' if in_list else '</ul>')
+        heading = re.match(r'(#+) (.*)', line)
+        if heading:
+            level = len(heading.group(1))
+            out.append('<h%d>%s</h%d>' % (level, inline(heading.group(2)), level))
+        elif in_list:
+            out.append('<li>%s</li>' % inline(line[2:]))
+        elif line:
+            out.append('<p>%s</p>' % inline(line))
+    if in_list:
+        out.append('</ul>')
+    return '\n'.join(out)
+
+
+def card(header, body=None, color=None):
+    style = ' style="background-color: %s"' % color if color else ''
+    html = '<div class="card"%s><div class="card-header"><b>%s</b></div>' % (
+        style, escape(header))
+    if body is not None:
+        html += '<div class="card-body"><b>%s</b></div>' % escape(str(body))
+    return html + '</div>'
+
+
+def totals(total, employee, student, vendor, per_capita, margin="5px"):
+    cols = [
+        card("Total", total),
+        card("Employee", employee, getColorForType("Employee")),
+        card("Vendor/Visitor", vendor, getColorForType("Vendor/Visitor")),
+        card("Student (%)", "%d (%.2f%%)" % (student, student/per_capita*100),
+             getColorForType("Student")),
+    ]
+    return '<div style="margin: %s"><div class="row">%s</div></div>' % (
+        margin, ''.join('<div class="col">%s</div>' % col for col in cols))
+
+
+def header(text):
+    return '<div class="row"><div class="col align-self-center">%s</div></div>' % card(text)
+
+
+def graph(path, style=''):
+    return '<div data-figure="%s" style="%s"></div>' % (escape(path), style)
+
+
+class Exporter:
+    def __init__(self, root='_export'):
+        self.root = root
+
+    def getPath(self, *parts):
+        return os.path.join(self.root, *parts)
+
+    def page(self, path, content, dataset=None):
+        """Writes a page at path, relative to the export root, with the
+        navigation of the app around the content."""
+        up = '../' * path.count('/')
+        year = dataset['id'] + '/' if dataset else list(datasets)[0] + '/'
+        links = [("About", "about.html"), ("Totals", year + "index.html"),
+                 ("By School", year + "schools.html"), ("Map", year + "map.html"),
+                 ("Compare years", "compare.html")]
+        links.extend((d['name'], d['id'] + '/index.html')
+                     for d in datasets.values())
+        nav = ''.join('<li class="nav-item"><a class="nav-link" href="%s%s">%s</a></li>' % (up, href, escape(label))
+                      for label, href in links)
+        writeText(self.getPath(path), """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<title>%(title)s</title>
+<link rel="stylesheet" href="%(css)s">
+<script src="%(up)splotly.min.js"></script>
+</head>
+<body>
+<nav class="navbar navbar-dark bg-dark"><a class="navbar-brand" href="%(up)sindex.html">%(title)s</a></nav>
+<ul class="nav">%(nav)s</ul>
+%(year)s%(content)s
+<script src="%(up)sexport.js"></script>
+</body>
+</html>
+""" % {'title': escape(title), 'css': dbc.themes.BOOTSTRAP, 'up': up, 'nav': nav,
+            'year': '<h5 style="margin: 5px">%s</h5>\n' % escape(dataset['name']) if dataset else '',
+            'content': content})
+
+    def figure(self, path, fig):
+        writeText(self.getPath(path), figureToJson(serveFigure(fig)))
+
+    def exportDataset(self, dataset):
+        dataset_id = dataset['id']
+        data = Data(dataset)
+        plots = Plots(data, client_modes=False)
+        summary = summarize(data)
+        schools = getRenderedSchools(plots)
+
+        def writer(path, build, *args):
+            return lambda: self.figure(path, build(plots, *args))
+
+        writers = [writer('%s/figures/%s.json' % (dataset_id, kind), build)
+                   for kind, build in dataset_figures.items()]
+        for school in schools:
+            for kind, build in school_figures.items():
+                writers.append(writer('%s/figures/schools/%s/%s.json' %
+                                      (dataset_id, quote(school, safe=''), kind), build, school))
+        buildFigures(writers)
+
+        content = [totals(*summary['totals'])]
+        for text, kind in totals_graphs:
+            content.append(header(text))
+            content.append(graph('figures/%s.json' % kind))
+        self.page(dataset_id + '/index.html', '\n'.join(content), dataset)
+
+        self.page(dataset_id + '/map.html',
+                  graph('figures/map.json', 'height: 100vh'), dataset)
+
+        links = ''.join('<li><a href="schools/%s.html">%s</a></li>' % (quote(quote(school, safe='')), escape(school))
+                        for school in schools)
+        self.page(dataset_id + '/schools.html', '<ul>%s</ul>' % links, dataset)
+
+        for school in schools:
+            name = quote(school, safe='')
+            figures = '../figures/schools/%s/' % quote(name)
+            level = summary['schools'][school]['level']
+            content = [
+                header(school),
+                totals(*summary['schools'][school]['totals'], "5px 50px 5px"),
+                '<br><p style="margin: 5px">Confirmed cases by type</p>',
+                graph(figures + 'by_type.json'),
+                '<br><p style="margin: 5px">Distribution vs %s and all schools</p>' % escape(level),
+                graph(figures + 'distribution.json'),
+            ]
+            self.page('%s/schools/%s.html' % (dataset_id, name), '\n'.join(content), dataset)
+        return data
+
+    def export(self):
+        loaded = {}
+        for dataset in datasets.values():
+            loaded[dataset['id']] = self.exportDataset(dataset)
+            print("exported %s" % dataset['id'])
+
+        self.figure('figures/compare.json',
+                    plotYearOverYear(SchoolYears(dict(reversed(loaded.items())))))
+        self.page('compare.html', header("Cumulative cases by day of the school year") +
+                  graph('figures/compare.json'))
+
+        with open("ABOUT.md", "r") as f:
+            about = markdownToHtml(f.read())
+        self.page('about.html', '<div class="row"><div class="col-10 offset-1">%s</div></div>' % about)
+
+        latest = list(datasets)[0]
+        writeText(self.getPath('index.html'),
+                  '<!DOCTYPE html>\n<meta http-equiv="refresh" content="0; url=%s/index.html">\n' % latest)
+        writeText(self.getPath('plotly.min.js'), get_plotlyjs())
+        writeText(self.getPath('export.js'), loader % json.dumps(config))
+
+
+if __name__ == "__main__":
+    Exporter(sys.argv[1] if len(sys.argv) > 1 else '_export').export()
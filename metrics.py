@@ -0,0 +1,119 @@
+"""Optional per-stage timings and cache counters, served at /metrics.
+
+Turned on by setting OCPS_METRICS=1 in the environment. When it's off,
+`timed` and `counted` hand back the function they decorate unchanged and
+`count` returns straight away, so the instrumentation costs nothing.
+
+The numbers are per process and exposed in the Prometheus text format.
+"""
+from functools import wraps
+import os
+import threading
+import time
+
+enabled = os.environ.get('OCPS_METRICS', '') not in ('', '0')
+
+lock = threading.Lock()
+stages = {}  # stage -> [calls, total seconds]
+misses = {}  # memoized stage -> calls that weren't served from the cache
+counters = {}  # (name, result) -> count
+
+
+def observe(stage, seconds):
+    with lock:
+        entry = stages.setdefault(stage, [0, 0.0])
+        entry[0] += 1
+        entry[1] += seconds
+
+
+def count(name, result):
+    if not enabled:
+        return
+    with lock:
+        counters[(name, result)] = counters.get((name, result), 0)+1
+
+
+def timed(stage):
+    """Records how long every call to the decorated function takes."""
+    def decorator(fn):
+        if not enabled:
+            return fn
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                observe(stage, time.perf_counter()-start)
+        return wrapper
+    return decorator
+
+
+def counted(stage):
+    """Counts cache misses of a memoized function.
+
+    Goes between the cache decorator and the function, under a `timed` with
+    the same stage name; every call that reaches it missed the cache.
+    """
+    def decorator(fn):
+        if not enabled:
+            return fn
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with lock:
+                misses[stage] = misses.get(stage, 0)+1
+            return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def render():
+    with lock:
+        stage_items = sorted(stages.items())
+        counter_items = sorted(counters.items())
+        for stage, missed in misses.items():
+            calls = stages.get(stage, [missed])[0]
+            counter_items.append(((stage, 'miss'), missed))
+            counter_items.append(((stage, 'hit'), max(calls-missed, 0)))
+
+    lines = [
+        '# HELP ocps_stage_seconds Time spent in each stage.',
+        '# TYPE ocps_stage_seconds summary',
+    ]
+    for stage, (calls, seconds) in stage_items:
+        lines.append('ocps_stage_seconds_count{stage="%s"} %d' % (stage, calls))
+        lines.append('ocps_stage_seconds_sum{stage="%s"} %f' % (stage, seconds))
+    lines.extend([
+        '# HELP ocps_cache_requests_total Cache lookups by result.',
+        '# TYPE ocps_cache_requests_total counter',
+    ])
+    for (name, result), n in sorted(counter_items):
+        lines.append('ocps_cache_requests_total{cache="%s",result="%s"} %d' %
+                     (name, result, n))
+    return '\n'.join(lines)+'\n'
+
+
+def register(server):
+    """Adds the /metrics endpoint, and times whole Dash callback requests
+    which, compared to the callbacks' own stages, shows the time spent
+    serializing the response."""
+    if not enabled:
+        return
+    from flask import Response, g, request
+
+    @server.before_request
+    def startTimer():
+        g.metrics_start = time.perf_counter()
+
+    @server.after_request
+    def stopTimer(response):
+        if request.path.endswith('_dash-update-component') and 'metrics_start' in g:
+            observe('dash_update_component',
+                    time.perf_counter()-g.metrics_start)
+        return response
+
+    @server.route('/metrics')
+    def showMetrics():
+        return Response(render(), mimetype='text/plain; version=0.0.4')
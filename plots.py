@@ -1,11 +1,19 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import base64
+import json
+import os
+import threading
 from data import *
+import metrics
 
+import numpy as np
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
 from plotly.graph_objs import layout
 from plotly.subplots import make_subplots
+from plotly.utils import PlotlyJSONEncoder
 
 color_map_by_level = {
     'Elementary': px.colors.qualitative.Plotly[0],
@@ -20,6 +28,174 @@ color_map_by_type = {
 }
 
 
+# Threads that build independent figures at the same time, see buildFigures
+figure_workers = int(os.environ.get(
+    'OCPS_FIGURE_WORKERS', min(4, os.cpu_count() or 1)))
+figure_pool = None
+figure_pool_lock = threading.Lock()
+
+
+def getFigurePool():
+    global figure_pool
+    with figure_pool_lock:
+        if figure_pool is None:
+            figure_pool = ThreadPoolExecutor(
+                max_workers=figure_workers, thread_name_prefix='figures')
+        return figure_pool
+
+
+def buildFigures(builders):
+    """Calls every builder, concurrently on the shared figure pool, and
+    returns their results in the same order.
+
+    A thread pool rather than processes, the Data and Plots objects would
+    otherwise have to be pickled over to every worker. Builders must not
+    call buildFigures themselves, they could end up waiting on a full pool.
+    """
+    if figure_workers < 2 or len(builders) < 2:
+        return [build() for build in builders]
+    return list(getFigurePool().map(lambda build: build(), builders))
+
+
+# Serve figures with compactFigure applied, needs plotly.js 2.28 or newer in
+# the browser for the typed arrays
+compact_figures = os.environ.get('OCPS_COMPACT_FIGURES', '') not in ('', '0')
+
+# Trace attributes that hold plain arrays of numbers
+numeric_arrays = [('x',), ('y',), ('lat',), ('lon',), ('marker', 'size')]
+
+
+def encodeArray(values):
+    """Plotly's base64 typed array form of a 1d array of numbers, or None
+    for anything else and when the plain list would be shorter anyway."""
+    try:
+        values = np.asarray(values)
+    except ValueError:
+        return None
+    if values.ndim != 1 or len(values) < 2 or values.dtype.kind not in 'iuf':
+        return None
+    if values.dtype.kind in 'iu' and np.abs(values).max() < 2**31:
+        dtype, values = 'i4', values.astype('<i4')
+    else:
+        dtype, values = 'f8', values.astype('<f8')
+    bdata = base64.b64encode(values.tobytes()).decode('ascii')
+    if len(bdata) >= len(json.dumps(values.tolist())):
+        return None
+    return {'dtype': dtype, 'bdata': bdata}
+
+
+def getDailyStep(values):
+    """The step in ms between evenly spaced dates, or None."""
+    if values is None or len(values) < 3:
+        return None
+    values = np.asarray(values)
+    if values.dtype.kind != 'M' and not isinstance(values[0], datetime):
+        return None
+    dates = pd.DatetimeIndex(values)
+    steps = np.diff(dates.asi8)
+    if not (steps == steps[0]).all() or steps[0] <= 0:
+        return None
+    return int(steps[0] // 10**6)
+
+
+def compactFigure(fig, typed_arrays=True):
+    """The figure as a dict that takes fewer bytes to send and to parse.
+
+    Evenly spaced dates, like the daily running totals behind every mode of
+    plotBy, are sent as a start and a step rather than repeated for every
+    trace, and arrays of numbers are sent as base64 typed arrays.
+    """
+    figure = fig.to_dict() if isinstance(fig, go.Figure) else fig
+    for trace in figure['data']:
+        step = getDailyStep(trace.get('x'))
+        if step is not None:
+            trace['x0'] = pd.Timestamp(trace.pop('x')[0]).isoformat()
+            trace['dx'] = step
+        if not typed_arrays:
+            continue
+        for path in numeric_arrays:
+            parent = trace
+            for key in path[:-1]:
+                parent = parent.get(key, {})
+            if path[-1] in parent:
+                encoded = encodeArray(parent[path[-1]])
+                if encoded is not None:
+                    parent[path[-1]] = encoded
+    return figure
+
+
+def serveFigure(fig):
+    """The figure as it's handed to dcc.Graph, see compact_figures.
+
+    Always a plain dict, which is what gets cached: unpickling a go.Figure
+    validates every property again and takes longer than building some of
+    the figures.
+    """
+    return compactFigure(fig) if compact_figures else fig.to_dict()
+
+
+def figureToJson(fig):
+    if isinstance(fig, go.Figure):
+        return fig.to_json()
+    return json.dumps(fig, cls=PlotlyJSONEncoder, separators=(',', ':'))
+
+
+# Build figures with only their first mode (new cases, by count) and switch
+# between the modes in the browser, see assets/modes.js
+client_modes = os.environ.get('OCPS_CLIENT_MODES', '') not in ('', '0')
+
+# Set OCPS_PLOT_FREQ to a pandas frequency, e.g. W, to draw the cases over
+# time in weekly (or other) bars rather than daily ones, which for views
+# over long ranges are fewer points to send and draw
+plot_freq = os.environ.get('OCPS_PLOT_FREQ') or None
+
+# (label, transform, tick format) of the modes each kind of figure has, the
+# transforms are implemented in assets/modes.js
+running_modes = [
+    ("New cases", 'identity', '.0'),
+    ("Cumulative", 'cumulative', '.0'),
+    ("Cumulative per capita", 'cumulative_per_capita', '.2%'),
+]
+ratio_modes = [
+    ("By count", 'identity', '.0'),
+    ("Per capita", 'per_capita', '.2%'),
+]
+figure_modes = {
+    'by_type': running_modes,
+    'by_level': running_modes,
+    'distribution': ratio_modes,
+}
+
+
+def getModesMeta(axis, modes, enrollment=None, trace_enrollment=None):
+    """layout.meta of a client_modes figure: the axis the counts are on,
+    and the enrollment to divide them by, either one list shared by every
+    trace or one list per trace."""
+    meta = {'axis': axis, 'modes': modes}
+    if enrollment is not None:
+        meta['enrollment'] = list(enrollment)
+    if trace_enrollment is not None:
+        meta['trace_enrollment'] = [list(e) for e in trace_enrollment]
+    return meta
+
+
+# Base layer of the map, 'white-bg' draws no tiles so needs no internet access
+map_style = os.environ.get('OCPS_MAP_STYLE', 'open-street-map')
+# GeoJSON drawn over the base layer when the file exists, like an outline of
+# the district for when there are no tiles
+map_outline = os.environ.get(
+    'OCPS_MAP_OUTLINE', os.path.join('data', 'district.geojson'))
+map_size_max = 50
+
+
+def getMapLayers():
+    if not os.path.exists(map_outline):
+        return []
+    with open(map_outline) as f:
+        outline = json.load(f)
+    return [{'source': outline, 'type': 'line', 'color': '#888', 'line': {'width': 1}}]
+
+
 def getColorForType(type):
     return color_map_by_type[type]
 
@@ -39,77 +215,71 @@ class Plots:
 
     margin = {'l': 5, 'r': 5, 'b': 50, 't': 50}
 
-    def __init__(self, data):
+    def __init__(self, data, freq=plot_freq, client_modes=client_modes):
         self.data = data
+        # Resample plotBy to this pandas frequency, e.g. 'W' for weekly bars
+        self.freq = freq
+        self.client_modes = client_modes
         self.df = self.getMapData()
 
     def getMapData(self):
-        df = self.data.df
-        df = df[df.date >= datetime(2000, 1, 1)]
-        df = df.dropna()
-        return df
+        return self.data.getPlottedDf()
 
-    def plotBy(self, title, color_column, color_order, color_map, plot_df=None, demo_df=None):
+    @metrics.timed('plotBy')
+    def plotBy(self, title, color_column, color_order, color_map, location=None):
         fig = go.Figure()
-        if plot_df is None:
-            plot_df = self.df
-
-        if demo_df is None:
-            demo_df = self.data.demo_df
-
-        fill_dates = pd.date_range(plot_df.date.min(), plot_df.date.max())
+        new_df, cum_df, cum_pc_df = self.data.cube.select(
+            color_column, location)
+        enrollment = None
+        if self.client_modes:
+            enrollment = self.data.cube.getEnrollment(new_df.index, location)
+        if self.freq is not None:
+            new_df = new_df.resample(self.freq).sum()
+            cum_df = cum_df.resample(self.freq).last()
+            cum_pc_df = cum_pc_df.resample(self.freq).last()
+            if enrollment is not None:
+                enrollment = enrollment.resample(self.freq).last()
 
         new_count = 0
         # New cases
         for typ in color_order:
-            df = plot_df
-            df = df[df[color_column] == typ]
-            if df.empty:
+            if typ not in new_df:
                 continue
             new_count = new_count+1
-            df = df.groupby('date').confirmed.sum().reset_index()
+            df = new_df[typ]
+            # The running totals are summed up from these in the browser
+            if not self.client_modes:
+                df = df[df != 0]
 
-            fig.add_bar(x=df['date'], y=df.confirmed, name=typ,
+            fig.add_bar(x=df.index, y=df.values, name=typ,
                         marker={'color': color_map[typ]})
 
+        if self.client_modes:
+            fig.update_layout(legend=self.legend, xaxis_title="", yaxis_title="",
+                              margin=self.margin, barmode='stack',
+                              meta=getModesMeta('yaxis', running_modes, enrollment))
+            return fig
+
         cum_count = 0
         # Cumulative
         for typ in color_order:
-            df = plot_df
-            df = df[df[color_column] == typ]
-            if df.empty:
+            if typ not in cum_df:
                 continue
             cum_count = cum_count+1
-            df = df[['date', 'confirmed']].groupby(
-                ['date']).confirmed.sum()
-            df = df.reindex(fill_dates, fill_value=0).reset_index()
-            df.rename(columns={'index': 'date'}, inplace=True)
-            df.confirmed = df.confirmed.cumsum()
+            df = cum_df[typ]
 
-            fig.add_bar(x=df['date'], y=df.confirmed, name=typ,
+            fig.add_bar(x=df.index, y=df.values, name=typ,
                         visible=False, marker={'color': color_map[typ]})
 
         cum_pc_count = 0
         # Cumulative per capita
         for typ in color_order:
-            df = plot_df
-            df = df[df[color_column] == typ]
-            if df.empty:
+            if typ not in cum_pc_df:
                 continue
             cum_pc_count = cum_pc_count+1
-            df = df[['date', 'confirmed']].groupby(
-                ['date']).confirmed.sum()
-            df = df.reindex(fill_dates, fill_value=0).reset_index()
-            df.rename(columns={'index': 'date'}, inplace=True)
-
-            demo_df = demo_df[['date', 'total']].groupby(
-                ['date']).total.sum().reset_index()
-            df = pd.merge_asof(df, demo_df, on='date',
-                               direction='nearest', suffixes=(None, "_y"))
-            df['confirmed'] = df.apply(lambda x: x.confirmed/x.total, axis=1)
-            df.confirmed = df.confirmed.cumsum()
-
-            fig.add_bar(x=df['date'], y=df.confirmed, name=typ,
+            df = cum_pc_df[typ]
+
+            fig.add_bar(x=df.index, y=df.values, name=typ,
                         visible=False, marker={'color': color_map[typ]})
 
         fig.update_layout(legend=self.legend, xaxis_title="",
@@ -176,22 +346,29 @@ class Plots:
         return self.plotBy("Confirmed cases by Level", 'level', ['Elementary', 'Middle', 'High'], color_map_by_level)
 
     def plotBySchool(self, school):
-        df = self.df[self.df.location == school]
-        demo_df = self.data.demo_df
-        demo_df = demo_df[demo_df.location == school]
-        return self.plotBy("%s confirmed cases by date" % (school), 'type', ['Employee', 'Student', 'Vendor/Visitor'], color_map_by_type, df, demo_df)
+        return self.plotBy("%s confirmed cases by date" % (school), 'type', ['Employee', 'Student', 'Vendor/Visitor'], color_map_by_type, school)
+
+    @metrics.timed('plotRollingRate')
+    def plotRollingRate(self, location=None, days=14):
+        rate = self.data.getRollingRate(days, location=location)
+        fig = go.Figure()
+        fig.add_scatter(x=rate.index, y=rate.values, mode='lines', name="All",
+                        line={'color': getColorForLevel('All')},
+                        hovertemplate='%{y:.2f}<extra></extra>')
+        fig.update_layout(legend=self.legend, xaxis_title="",
+                          yaxis_title="Cases per 1,000 students", margin=self.margin)
+        return fig
 
+    @metrics.timed('plotMap')
     def plotMap(self, filter=[]):
-        df = self.df
-        df_bycount = df.groupby(
-            ['location', 'level', 'lat', 'long']).sum(['confirmed'])
-        df_bycount.dropna()
-        df = df_bycount.reset_index()
+        geo = self.data.map
+        df = geo.locations.assign(confirmed=geo.confirmed())
 
         fig = px.scatter_mapbox(df, lat="lat", lon="long",
-                                color_discrete_map=color_map_by_level, zoom=9, color='level', size='confirmed', size_max=50, opacity=.75, hover_name='location', hover_data=['level', 'confirmed'])
+                                color_discrete_map=color_map_by_level, zoom=9, color='level', size='confirmed', size_max=map_size_max, opacity=.75, hover_name='location', hover_data=['level', 'confirmed'])
 
-        fig.update_layout(mapbox_style="open-street-map", margin=self.margin)
+        fig.update_layout(mapbox_style=map_style, mapbox_layers=getMapLayers(),
+                          margin=self.margin, meta=self.getMapMeta(df, fig))
 
         legend = dict(
             orientation="h",
@@ -205,6 +382,35 @@ class Plots:
                           xaxis_title="", yaxis_title="")
         return fig
 
+    def getMapMeta(self, df, fig):
+        """The running totals of every point on the map, for filtering it
+        by date in the browser with assets/map.js.
+
+        Sparse, each point gets the days its total changed on and the total
+        from then on, as most schools go most days without a case.
+        """
+        cum = self.data.map.cum
+        totals = cum.values
+        new = np.diff(totals, axis=0, prepend=0)
+        columns = {location: i for i, location in enumerate(df.location)}
+        days, cumulative = [], []
+        for trace in fig.data:
+            trace_days, trace_cumulative = [], []
+            for location in trace.hovertext:
+                changed = np.flatnonzero(new[:, columns[location]])
+                trace_days.append(changed.tolist())
+                trace_cumulative.append(
+                    totals[changed, columns[location]].tolist())
+            days.append(trace_days)
+            cumulative.append(trace_cumulative)
+        return {
+            'dates': [date.strftime('%Y-%m-%d') for date in cum.index],
+            'days': days,
+            'cumulative': cumulative,
+            'size_max': map_size_max,
+        }
+
+    @metrics.timed('plotDistributionsForSchool')
     def plotDistributionsForSchool(self, school):
         all = self.data.getDfTotalsByLocation()
         school_level = self.data.getLevelForSchool(school)
@@ -222,6 +428,13 @@ class Plots:
             fig.add_scatter(x=[confirmed], y=[level], marker={'symbol': 'star', 'size': 8}, showlegend=False,
                             legendgroup=level, hovertemplate='%{hovertext}<br>Confirmed:%{x}<extra></extra>', hovertext=[school])
 
+        if self.client_modes:
+            school_total = by_school.total.sum()
+            fig.update_yaxes(visible=False)
+            fig.update_layout(legend=self.legend, margin=self.margin, meta=getModesMeta(
+                'xaxis', ratio_modes, trace_enrollment=[all.total, [school_total], by_level.total, [school_total]]))
+            return fig
+
         for t in [('All', all), (school_level, by_level)]:
             level = t[0]
             df = t[1]
@@ -268,10 +481,11 @@ class Plots:
 
         return fig
 
+    @metrics.timed('plotDistributionByLevel')
     def plotDistributionByLevel(self, level):
         all = self.df
         all = all[['level', 'location', 'confirmed']].groupby(
-            ['level', 'location']).sum().reset_index()
+            ['level', 'location'], observed=True).sum().sort_index().reset_index()
 
         if level != 'All':
             all = all[all.level == level]
@@ -293,6 +507,7 @@ class Plots:
 
         return fig
 
+    @metrics.timed('plotDistribution')
     def plotDistribution(self):
         all = self.data.getDfTotalsByLocation()
 
@@ -302,6 +517,12 @@ class Plots:
             fig.add_box(x=df['confirmed'], name=level,
                         marker={'color': getColorForLevel(level), 'opacity': .5}, legendgroup=level, hovertext=df.location)
 
+        if self.client_modes:
+            fig.update_yaxes(visible=False)
+            fig.update_layout(legend=self.legend, xaxis_title="", yaxis_title="", margin=self.margin, meta=getModesMeta(
+                'xaxis', ratio_modes, trace_enrollment=[all[all.level == level].total for level in ['High', 'Middle', 'Elementary']]))
+            return fig
+
         for level in ['High', 'Middle', 'Elementary']:
             df = all[all.level == level]
             fig.add_box(x=df['confirmed_pc'], name=level, visible=False,
@@ -344,3 +565,56 @@ class Plots:
         fig.update_layout(legend=self.legend, xaxis_title="",
                           yaxis_title="", margin=self.margin)
         return fig
+
+
+@metrics.timed('plotYearOverYear')
+def plotYearOverYear(years):
+    """Cumulative cases per 1,000 students of every school year in
+    SchoolYears, lined up by the day of the school year."""
+    cases = years.getCasesBySchoolDay().cumsum()
+    fig = go.Figure()
+    for year_id in cases:
+        data = years.years[year_id]
+        students = pd.Series(data.getTotalStudentCount(), index=cases.index)
+        fig.add_scatter(x=cases.index, y=perCapita(cases[year_id], students)*1000,
+                        mode='lines', name=data.dataset.get('name', year_id))
+    fig.update_layout(legend=Plots.legend, margin=Plots.margin,
+                      xaxis_title="Day of the school year",
+                      yaxis_title="Cases per 1,000 students")
+    return fig
+
+
+# dcc.Graph config of every graph in the app and the static export
+config = {'modeBarButtonsToRemove': ["autoScale2d", "autoscale", "editInChartStudio", "editinchartstudio", "hoverCompareCartesian", "hovercompare", "lasso", "lasso2d", "orbitRotation", "orbitrotation", "pan", "pan2d", "pan3d", "reset", "resetCameraDefault3d", "resetCameraLastSave3d", "resetGeo", "resetSankeyGroup", "resetScale2d", "resetViewMapbox", "resetViews", "resetcameradefault",
+                                     "resetcameralastsave", "resetsankeygroup", "resetscale", "resetview", "resetviews", "select", "select2d", "sendDataToCloud", "senddatatocloud", "tableRotation", "tablerotation", "toImage", "toggleHover", "toggleSpikelines", "togglehover", "togglespikelines", "toimage", "zoom", "zoom2d", "zoom3d", "zoomIn2d", "zoomInGeo", "zoomInMapbox", "zoomOut2d", "zoomOutGeo", "zoomOutMapbox", "zoomin", "zoomout"]}
+
+
+# Graphs on the Totals page, in order, by their header and figure kind
+totals_graphs = [
+    ("Confirmed cases by Type", 'by_type'),
+    ("Confirmed cases by Level", 'by_level'),
+    ("Distribution of cases by Level", 'distribution'),
+    ("Distribution of confirmed cases in Elementary schools", 'distribution_elementary'),
+    ("Distribution of confirmed cases in Middle schools", 'distribution_middle'),
+    ("Distribution of confirmed cases in High schools", 'distribution_high'),
+    ("Cases in the last 14 days per 1,000 students", 'rolling'),
+]
+
+
+# Figures shown on the Totals and Map pages, by kind
+dataset_figures = {
+    'by_type': Plots.plotByType,
+    'by_level': Plots.plotByLevel,
+    'distribution': Plots.plotDistribution,
+    'distribution_elementary': lambda plots: plots.plotDistributionByLevel('Elementary'),
+    'distribution_middle': lambda plots: plots.plotDistributionByLevel('Middle'),
+    'distribution_high': lambda plots: plots.plotDistributionByLevel('High'),
+    'rolling': Plots.plotRollingRate,
+    'map': Plots.plotMap,
+}
+
+# Figures shown for each school on the /school page, by kind
+school_figures = {
+    'by_type': Plots.plotBySchool,
+    'distribution': Plots.plotDistributionsForSchool,
+}
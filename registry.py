@@ -0,0 +1,98 @@
+from collections import OrderedDict
+import copy
+import threading
+
+from data import Data, SchoolYears, getSourceStamp
+import metrics
+from plots import Plots
+
+
+class DatasetRegistry:
+    """Process wide Data/Plots objects, loaded once per dataset.
+
+    The objects are shared read-only by every request thread. When the
+    modification time of any of a dataset's source files changes, the next
+    request loads a fresh copy and swaps it in; requests already holding the
+    old copy keep using it until they finish. If only the cases file changed,
+    the fresh copy is made by ingesting just the appended rows.
+    """
+
+    # Date windows kept around, over all datasets, see getWindow
+    max_windows = 8
+
+    def __init__(self):
+        self.entries = {}
+        self.windows = OrderedDict()
+        self.years = None
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def getLock(self, key):
+        with self.lock:
+            return self.locks.setdefault(key, threading.Lock())
+
+    def get(self, dataset):
+        key = dataset['id']
+        stamp = getSourceStamp(dataset)
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == stamp:
+            metrics.count('registry', 'hit')
+            return entry[1], entry[2]
+
+        # Only one thread loads a given dataset, the others wait for it
+        with self.getLock(key):
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == stamp:
+                return entry[1], entry[2]
+            data = None
+            # The cases file is first in the stamp, see getSourceFiles
+            if entry is not None and entry[0][1:] == stamp[1:]:
+                data = copy.copy(entry[1])
+                if data.refresh():
+                    metrics.count('registry', 'refresh')
+                else:
+                    data = None
+            if data is None:
+                metrics.count('registry', 'miss')
+                data = Data(dataset)
+            plots = Plots(data)
+            self.entries[key] = (stamp, data, plots)
+            return data, plots
+
+    def getWindow(self, dataset, start=None, end=None):
+        """Data/Plots objects restricted to the cases between the dates, see
+        Data.window. The most recently used windows are kept, for as long as
+        the dataset they were cut from is current."""
+        data, plots = self.get(dataset)
+        if start is None and end is None:
+            return data, plots
+        key = (dataset['id'], start, end)
+        with self.lock:
+            entry = self.windows.get(key)
+            if entry is not None and entry[0] is data:
+                self.windows.move_to_end(key)
+                return entry[1], entry[2]
+
+        window = data.window(start, end)
+        window_plots = Plots(window)
+        with self.lock:
+            self.windows[key] = (data, window, window_plots)
+            self.windows.move_to_end(key)
+            while len(self.windows) > self.max_windows:
+                self.windows.popitem(last=False)
+        return window, window_plots
+
+    def getYears(self, datasets):
+        """SchoolYears over the datasets, oldest first, made again only when
+        one of them is reloaded."""
+        loaded = {dataset['id']: self.get(dataset)[0] for dataset in datasets}
+        years = self.years
+        if years is None or years.years != loaded:
+            years = SchoolYears(loaded)
+            self.years = years
+        return years
+
+    def clear(self):
+        self.entries = {}
+        self.windows = OrderedDict()
+        self.years = None
@@ -0,0 +1,138 @@
+"""Pre-renders every figure to Plotly JSON, so that requests don't have to.
+
+Run after the nightly scripts fetch new data:
+
+    python render.py
+
+Figures are written to _figures/<dataset id>/<content hash>/ and listed in
+_figures/manifest.json along with the hash of the source files they were
+built from. The app serves a figure from here as long as that hash still
+matches the data on disk and falls back to building it otherwise.
+"""
+import json
+import os
+import shutil
+from urllib.parse import quote
+
+from data import Data, compact_data, datasets, getContentHash, writeText
+import metrics
+from plots import (Plots, buildFigures, client_modes, compact_figures,
+                   dataset_figures, figureToJson, map_outline, map_style,
+                   plot_freq, school_figures, serveFigure)
+
+
+def toJson(obj):
+    # numpy scalars from pandas aren't json serializable
+    return json.dumps(obj, default=lambda x: x.item())
+
+
+def summarize(data):
+    """Everything besides the figures that the pages show, as plain python."""
+    schools = {}
+    for school in data.getLocationsList():
+        schools[school] = {
+            'level': data.getLevelForSchool(school),
+            'totals': list(data.getTotalsForSchool(school)),
+        }
+    return {
+        'totals': [data.getTotalConfirmedCases(), data.getTotalEmployeeCases(),
+                   data.getTotalStudentCases(), data.getTotalVendorVisitorCases(),
+                   data.getTotalStudentCount()],
+        'locations': data.getLocationsList(),
+        'schools': schools,
+    }
+
+
+def getRenderedSchools(plots):
+    # Schools without a directory match have no level and can't be plotted
+    return sorted(plots.df.location.unique())
+
+
+class FigureStore:
+    def __init__(self, root='_figures'):
+        self.root = root
+        self.manifest = {}
+        self.manifest_mtime = None
+
+    def getManifestPath(self):
+        return os.path.join(self.root, 'manifest.json')
+
+    def getManifest(self):
+        try:
+            mtime = os.path.getmtime(self.getManifestPath())
+        except OSError:
+            return {}
+        if mtime != self.manifest_mtime:
+            with open(self.getManifestPath()) as f:
+                self.manifest = json.load(f)
+            self.manifest_mtime = mtime
+        return self.manifest
+
+    def getPath(self, dataset_id, content_hash, name, school=None):
+        path = [self.root, dataset_id, content_hash]
+        if school is not None:
+            path.extend(['schools', quote(school, safe='')])
+        path.append(name + '.json')
+        return os.path.join(*path)
+
+    def load(self, dataset, name, school=None):
+        """The rendered json for the name, or None if it isn't rendered for
+        the current data."""
+        entry = self.getManifest().get(dataset['id'])
+        if (entry is None or entry['hash'] != getContentHash(dataset)
+                or entry.get('compact', False) != compact_figures
+                or entry.get('compact_data', False) != compact_data
+                or entry.get('client_modes', False) != client_modes
+                or entry.get('freq') != plot_freq
+                or entry.get('map_style') != map_style
+                or entry.get('map_outline') != map_outline):
+            metrics.count('figure_store', 'miss')
+            return None
+        try:
+            with open(self.getPath(dataset['id'], entry['hash'], name, school)) as f:
+                blob = json.load(f)
+        except OSError:
+            metrics.count('figure_store', 'miss')
+            return None
+        metrics.count('figure_store', 'hit')
+        return blob
+
+    def render(self, dataset):
+        dataset_id = dataset['id']
+        content_hash = getContentHash(dataset)
+        data = Data(dataset)
+        plots = Plots(data)
+
+        def writer(path, build, *args):
+            return lambda: writeText(path, figureToJson(serveFigure(build(plots, *args))))
+
+        writers = []
+        for kind, build in dataset_figures.items():
+            writers.append(
+                writer(self.getPath(dataset_id, content_hash, kind), build))
+        for school in getRenderedSchools(plots):
+            for kind, build in school_figures.items():
+                writers.append(writer(
+                    self.getPath(dataset_id, content_hash, kind, school), build, school))
+        buildFigures(writers)
+        writeText(self.getPath(dataset_id, content_hash, 'summary'),
+                  toJson(summarize(data)))
+
+        manifest = dict(self.getManifest())
+        manifest[dataset_id] = {'hash': content_hash, 'compact': compact_figures,
+                                'compact_data': compact_data,
+                                'client_modes': client_modes, 'freq': plot_freq,
+                                'map_style': map_style, 'map_outline': map_outline}
+        writeText(self.getManifestPath(), json.dumps(manifest, indent=2))
+
+        # Drop renders of older data
+        for old in os.listdir(os.path.join(self.root, dataset_id)):
+            if old != content_hash:
+                shutil.rmtree(os.path.join(self.root, dataset_id, old))
+
+
+if __name__ == "__main__":
+    store = FigureStore()
+    for dataset in datasets.values():
+        store.render(dataset)
+        print("rendered %s" % dataset['id'])
@@ -0,0 +1,97 @@
+"""Synthetic data in the same csv layouts as the files under data/.
+
+Used by benchmark.py to measure how Data and Plots scale without needing the
+real data:
+
+    python synthetic.py out_dir --schools 500 --days 180 --years 3
+"""
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+levels = ['Elementary', 'Middle', 'High']
+types = ['Employee', 'Student', 'Vendor/Visitor']
+
+
+def getSchoolNames(schools):
+    """(cases name, directory name, level) for every school.
+
+    The names in the cases and directory files differ the same way the real
+    ones do, so the name normalization is part of what gets measured.
+    """
+    names = []
+    for i in range(schools):
+        level = levels[i % len(levels)]
+        names.append(("St. Synthetic-%d %s School" % (i, level),
+                      "Synthetic %d %s" % (i, level), level))
+    return names
+
+
+def writeDatasets(out_dir, schools=200, days=180, years=2, seed=0):
+    """Writes one cases file per school year along with the shared
+    directory and demographics files, and returns a dataset dict for each
+    year, newest first like the ones in data.py.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    names = getSchoolNames(schools)
+    first_year = 2021 - years + 1
+
+    directory = os.path.join(out_dir, 'directory.csv')
+    pd.DataFrame({
+        'location': [n[1] for n in names],
+        'level': [n[2] for n in names],
+        'lat': rng.uniform(28.3, 28.8, schools),
+        'long': rng.uniform(-81.6, -81.1, schools),
+    }).to_csv(directory, index=False)
+
+    # An enrollment snapshot at the start and the middle of every year
+    snapshots = []
+    for year in range(first_year, first_year+years):
+        snapshots.extend([pd.Timestamp(year, 9, 1), pd.Timestamp(year+1, 1, 15)])
+    demographics = os.path.join(out_dir, 'demographics.csv')
+    pd.DataFrame({
+        'date': np.repeat(snapshots, schools),
+        'location': np.tile([n[0] for n in names], len(snapshots)),
+        'total': rng.integers(300, 3000, schools*len(snapshots)),
+    }).to_csv(demographics, index=False)
+
+    datasets = []
+    for year in range(first_year, first_year+years):
+        name = '%d-%d' % (year, year+1)
+        dates = pd.date_range(pd.Timestamp(year, 8, 10), periods=days)
+        cells = len(dates)*schools*len(types)
+        # Most school days have no cases at a given school
+        has_cases = rng.random(cells) < .05
+        df = pd.DataFrame({
+            'date': np.repeat(dates, schools*len(types)),
+            'location': np.tile(np.repeat([n[0] for n in names], len(types)), len(dates)),
+            'type': np.tile(types, len(dates)*schools),
+            'count': rng.integers(1, 5, cells),
+        })[has_cases]
+        df['date'] = df.date.dt.strftime('%Y-%m-%d')
+        cases = os.path.join(out_dir, '%s-cases.csv' % name)
+        df.to_csv(cases, index=False)
+
+        datasets.append({
+            'id': 'synthetic%d' % year,
+            'name': name,
+            'file': cases,
+            'directory': directory,
+            'demographics': demographics,
+            'snapshot': os.path.join(out_dir, name),
+        })
+    return datasets[::-1]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('out_dir')
+    parser.add_argument('--schools', type=int, default=200)
+    parser.add_argument('--days', type=int, default=180)
+    parser.add_argument('--years', type=int, default=2)
+    args = parser.parse_args()
+    for dataset in writeDatasets(args.out_dir, args.schools, args.days, args.years):
+        print(dataset['file'])
@@ -0,0 +1,54 @@
+import time
+
+from cache_backends import LRUFileSystemCache
+
+
+def test_prune_removes_least_recently_used(tmp_path):
+    cache = LRUFileSystemCache(str(tmp_path), threshold=5, default_timeout=0)
+    for key in 'abcdef':
+        cache.set(key, key)
+        time.sleep(0.01)
+    assert cache.get('a') == 'a'
+    time.sleep(0.01)
+
+    # Over the threshold, the set prunes the two oldest, b and c, first
+    cache.set('g', 'g')
+    assert [key for key in 'abcdefg' if cache.get(key) is not None] == ['a', 'd', 'e', 'f', 'g']
+    cache.set('h', 'h')
+    assert cache.get('h') == 'h'
+
+
+def test_two_tier_over_a_class_named_backend():
+    from flask import Flask
+    from flask_caching import Cache
+
+    cache = Cache(Flask(__name__), config={
+        'CACHE_TYPE': 'cache_backends.twoTier',
+        'CACHE_SHARED_TYPE': 'SimpleCache',
+        'CACHE_MEMORY_THRESHOLD': 1,
+    }).cache
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert list(cache.entries) == ['b']
+    assert cache.get('a') == 1  # From the shared tier
+    assert list(cache.entries) == ['a']
+
+
+def test_add_lets_one_caller_through(tmp_path):
+    from concurrent.futures import ThreadPoolExecutor
+
+    cache = LRUFileSystemCache(str(tmp_path), threshold=100, default_timeout=0)
+    with ThreadPoolExecutor(8) as pool:
+        added = list(pool.map(lambda i: cache.add('lease', i), range(32)))
+    assert added.count(True) == 1
+    assert cache.get('lease') == added.index(True)
+    assert len(list(cache._list_dir())) == 1
+
+
+def test_add_replaces_an_expired_value(tmp_path):
+    cache = LRUFileSystemCache(str(tmp_path), threshold=100, default_timeout=0)
+    assert cache.add('lease', 1, timeout=1)
+    assert not cache.add('lease', 2, timeout=1)
+    time.sleep(1.1)
+    assert cache.add('lease', 3, timeout=1)
+    assert cache.get('lease') == 3
@@ -0,0 +1,47 @@
+import pandas as pd
+import pytest
+
+from data import Data
+import synthetic
+
+
+@pytest.mark.parametrize('snapshot', [False, True])
+def test_compact_plots_the_same_rows(tmp_path, snapshot):
+    dataset = synthetic.writeDatasets(str(tmp_path), schools=10, days=40, years=1)[0]
+    # A directory column the plots don't use, blank for one school
+    directory = pd.read_csv(dataset['directory'])
+    directory['phone'] = '407-555-0100'
+    directory.loc[0, 'phone'] = None
+    directory.to_csv(dataset['directory'], index=False)
+
+    data = Data(dataset, snapshot=False)
+    compact = Data(dataset, snapshot=False, compact=True)
+    if snapshot:
+        pytest.importorskip('pyarrow.feather', exc_type=ImportError)
+        compact.writeSnapshot()
+        compact = Data(dataset)
+    assert len(compact.getPlottedDf()) == len(data.getPlottedDf())
+    assert compact.cube.cum.values.sum() == data.cube.cum.values.sum()
+    assert len(compact.map.locations) == len(data.map.locations)
+    assert compact.getTotalConfirmedCases() == data.getTotalConfirmedCases()
+
+
+def test_compact_refresh_keeps_the_marks(tmp_path):
+    dataset = synthetic.writeDatasets(str(tmp_path), schools=10, days=40, years=1)[0]
+    directory = pd.read_csv(dataset['directory'])
+    directory['phone'] = '407-555-0100'
+    directory.loc[0, 'phone'] = None
+    directory.to_csv(dataset['directory'], index=False)
+    with open(dataset['file']) as f:
+        header, *lines = f.readlines()
+
+    with open(dataset['file'], 'w') as f:
+        f.writelines([header] + lines[:len(lines)//2])
+    compact = Data(dataset, snapshot=False, compact=True)
+    with open(dataset['file'], 'a') as f:
+        f.writelines(lines[len(lines)//2:])
+    assert compact.refresh()
+
+    data = Data(dataset, snapshot=False)
+    assert len(compact.getPlottedDf()) == len(data.getPlottedDf())
+    assert compact.cube.cum.values.sum() == data.cube.cum.values.sum()
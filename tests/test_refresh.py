@@ -0,0 +1,56 @@
+import pandas as pd
+import pytest
+
+from data import Data
+import synthetic
+
+
+def assertSameCube(a, b):
+    for name in ['new', 'cum', 'cum_pc']:
+        x, y = getattr(a.cube, name).copy(), getattr(b.cube, name).copy()
+        # One side may have categorical levels, compare the labels
+        x.columns = pd.MultiIndex.from_tuples(list(x.columns))
+        y.columns = pd.MultiIndex.from_tuples(list(y.columns))
+        pd.testing.assert_frame_equal(x, y, check_freq=False)
+
+
+@pytest.mark.parametrize('gap', [0, 3])
+def test_refresh_matches_reload(tmp_path, gap):
+    dataset = synthetic.writeDatasets(str(tmp_path), schools=10, days=40, years=1)[0]
+    with open(dataset['file']) as f:
+        header, *lines = f.readlines()
+    cut = '2021-08-30'
+    first = [line for line in lines if line[:10] <= cut]
+    # Rows for the `gap` days after the cut are never written
+    resume = (pd.Timestamp(cut)+pd.Timedelta(days=gap+1)).strftime('%Y-%m-%d')
+    rest = [line for line in lines if line[:10] >= resume]
+
+    with open(dataset['file'], 'w') as f:
+        f.writelines([header] + first)
+    data = Data(dataset, snapshot=False)
+    with open(dataset['file'], 'a') as f:
+        f.writelines(rest)
+    assert data.refresh()
+
+    reloaded = Data(dataset, snapshot=False)
+    assertSameCube(data, reloaded)
+    assert data.getTotalConfirmedCases() == reloaded.getTotalConfirmedCases()
+
+
+def test_partial_last_line_is_left_for_refresh(tmp_path):
+    dataset = synthetic.writeDatasets(str(tmp_path), schools=10, days=40, years=1)[0]
+    with open(dataset['file']) as f:
+        header, *lines = f.readlines()
+    last = lines.pop()
+
+    # Loaded while the scraper is half way through appending the last row
+    with open(dataset['file'], 'w') as f:
+        f.writelines([header] + lines + [last[:len(last)//2]])
+    data = Data(dataset, snapshot=False)
+    with open(dataset['file'], 'a') as f:
+        f.write(last[len(last)//2:])
+    assert data.refresh()
+
+    reloaded = Data(dataset, snapshot=False)
+    assertSameCube(data, reloaded)
+    assert data.getTotalConfirmedCases() == reloaded.getTotalConfirmedCases()
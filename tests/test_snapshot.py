@@ -0,0 +1,23 @@
+import pytest
+
+from data import Data, getSnapshotFiles, readFrame, writeFrame
+import synthetic
+
+# A pyarrow built against another numpy raises ImportError rather than
+# ModuleNotFoundError
+pytest.importorskip('pyarrow.feather', exc_type=ImportError)
+
+
+def test_snapshot_without_refresh_metadata_falls_back_to_csv(tmp_path):
+    dataset = synthetic.writeDatasets(str(tmp_path), schools=10, days=20, years=1)[0]
+    data = Data(dataset, snapshot=False)
+    data.writeSnapshot()
+    assert Data(dataset).dir_df is None  # Loaded from the snapshot
+
+    # As written before refresh() needed the offsets into the cases file
+    cases, _ = getSnapshotFiles(dataset)
+    df, _ = readFrame(cases)
+    writeFrame(df, cases)
+    loaded = Data(dataset)
+    assert loaded.dir_df is not None
+    assert loaded.getTotalConfirmedCases() == data.getTotalConfirmedCases()